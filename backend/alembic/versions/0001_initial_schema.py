@@ -0,0 +1,71 @@
+"""initial schema
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+Databases created before migrations existed (via Base.metadata.create_all)
+already have these tables; mark them with `alembic stamp 0001` and then run
+`alembic upgrade head`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(), nullable=False),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('hashed_password', sa.String(), nullable=False),
+        sa.Column('is_online', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_users_id', 'users', ['id'])
+    op.create_index('ix_users_username', 'users', ['username'], unique=True)
+    op.create_index('ix_users_email', 'users', ['email'], unique=True)
+
+    op.create_table(
+        'messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('sender_id', sa.Integer(), nullable=False),
+        sa.Column('receiver_id', sa.Integer(), nullable=False),
+        sa.Column('is_read', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['receiver_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['sender_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_messages_id', 'messages', ['id'])
+
+    op.create_table(
+        'chat_rooms',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('is_group', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_chat_rooms_id', 'chat_rooms', ['id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_rooms_id', table_name='chat_rooms')
+    op.drop_table('chat_rooms')
+    op.drop_index('ix_messages_id', table_name='messages')
+    op.drop_table('messages')
+    op.drop_index('ix_users_email', table_name='users')
+    op.drop_index('ix_users_username', table_name='users')
+    op.drop_index('ix_users_id', table_name='users')
+    op.drop_table('users')
@@ -0,0 +1,49 @@
+"""indexes for message hot queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:30:00.000000
+
+- conversation history: canonical pair (least, greatest) + (created_at, id)
+- unread counts: partial index over unread rows only
+- per-user listings and search: sender/receiver + time
+"""
+from alembic import op
+import sqlalchemy as sa
+from models import least, greatest
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+sender_id = sa.column('sender_id', sa.Integer)
+receiver_id = sa.column('receiver_id', sa.Integer)
+is_read = sa.column('is_read', sa.Boolean)
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_messages_conversation_created',
+        'messages',
+        [least(sender_id, receiver_id), greatest(sender_id, receiver_id), 'created_at', 'id'],
+    )
+    op.create_index(
+        'ix_messages_unread',
+        'messages',
+        ['receiver_id', 'sender_id'],
+        postgresql_where=~is_read,
+        sqlite_where=~is_read,
+    )
+    op.create_index('ix_messages_sender_created', 'messages', ['sender_id', 'created_at', 'id'])
+    op.create_index('ix_messages_receiver_created', 'messages', ['receiver_id', 'created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_receiver_created', table_name='messages')
+    op.drop_index('ix_messages_sender_created', table_name='messages')
+    op.drop_index('ix_messages_unread', table_name='messages')
+    op.drop_index('ix_messages_conversation_created', table_name='messages')
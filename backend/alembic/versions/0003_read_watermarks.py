@@ -0,0 +1,33 @@
+"""read watermarks per conversation
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'read_watermarks',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('partner_id', sa.Integer(), nullable=False),
+        sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['partner_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id', 'partner_id'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('read_watermarks')
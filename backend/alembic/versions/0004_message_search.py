@@ -0,0 +1,37 @@
+"""full-text search index on message content
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 10:30:00.000000
+
+Postgres only; SQLite uses the in-process index in search_index.py.
+On a large table, build it by hand first with CREATE INDEX CONCURRENTLY
+under the same name and this migration becomes a no-op.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.create_index(
+        'ix_messages_content_fts',
+        'messages',
+        [sa.text("to_tsvector('simple', content)")],
+        postgresql_using='gin',
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_messages_content_fts', table_name='messages')
@@ -0,0 +1,64 @@
+"""conversations inbox table
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 11:00:00.000000
+
+Backfills one row per user and chat partner from the newest message
+between them.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'conversations',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('partner_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=False),
+        sa.Column('last_sender_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_preview', sa.String(), nullable=False),
+        sa.Column('last_message_at', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['last_sender_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['partner_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id', 'partner_id'),
+    )
+    op.create_index(
+        'ix_conversations_user_last_message',
+        'conversations',
+        ['user_id', 'last_message_at', 'last_message_id'],
+    )
+    op.execute("""
+        INSERT INTO conversations (
+            user_id, partner_id, last_message_id, last_sender_id,
+            last_message_preview, last_message_at
+        )
+        SELECT pairs.user_id, pairs.partner_id, m.id, m.sender_id,
+               substr(m.content, 1, 100), m.created_at
+        FROM (
+            SELECT user_id, partner_id, max(last_id) AS last_id
+            FROM (
+                SELECT sender_id AS user_id, receiver_id AS partner_id, max(id) AS last_id
+                FROM messages GROUP BY sender_id, receiver_id
+                UNION ALL
+                SELECT receiver_id, sender_id, max(id)
+                FROM messages GROUP BY receiver_id, sender_id
+            ) directions
+            GROUP BY user_id, partner_id
+        ) pairs
+        JOIN messages m ON m.id = pairs.last_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_conversations_user_last_message', table_name='conversations')
+    op.drop_table('conversations')
@@ -0,0 +1,61 @@
+"""group room membership and messages
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Batch mode so SQLite can add the foreign key by rebuilding the table
+    with op.batch_alter_table('chat_rooms') as batch_op:
+        batch_op.add_column(sa.Column('created_by', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_chat_rooms_created_by', 'users', ['created_by'], ['id'])
+
+    op.create_table(
+        'room_members',
+        sa.Column('room_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('joined_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['room_id'], ['chat_rooms.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('room_id', 'user_id'),
+    )
+    op.create_index('ix_room_members_user', 'room_members', ['user_id'])
+
+    op.create_table(
+        'room_messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('room_id', sa.Integer(), nullable=False),
+        sa.Column('sender_id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['room_id'], ['chat_rooms.id']),
+        sa.ForeignKeyConstraint(['sender_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_room_messages_id', 'room_messages', ['id'])
+    op.create_index(
+        'ix_room_messages_room_created', 'room_messages', ['room_id', 'created_at', 'id']
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_room_messages_room_created', table_name='room_messages')
+    op.drop_index('ix_room_messages_id', table_name='room_messages')
+    op.drop_table('room_messages')
+    op.drop_index('ix_room_members_user', table_name='room_members')
+    op.drop_table('room_members')
+    with op.batch_alter_table('chat_rooms') as batch_op:
+        batch_op.drop_constraint('fk_chat_rooms_created_by', type_='foreignkey')
+        batch_op.drop_column('created_by')
@@ -1,18 +1,31 @@
+import json
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
 from models import User
 from schemas import TokenData
 from config import settings
+from cache import TTLCache, invalidate_user_profile
+from redis_client import async_redis_client, async_redis_manager
+from password_hashing import pwd_context, password_hasher
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# Decoded token -> sub, and sub -> principal fields, so an authenticated
+# request only reaches the database when its user isn't cached
+token_cache = TTLCache(settings.auth_cache_max_size, settings.auth_cache_ttl_seconds)
+principal_cache = TTLCache(settings.auth_cache_max_size, settings.auth_cache_ttl_seconds)
+PRINCIPAL_FIELDS = ("id", "username", "email", "is_online", "created_at")
+
+# Every worker drops its cached copy when a user changes their profile
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -45,9 +58,76 @@ def verify_token(token: str, credentials_exception):
     return token_data
 
 
-def get_current_user(
+def decode_token_subject(token: str) -> Optional[str]:
+    """The token's sub claim, or None if the token is invalid or expired"""
+    username = token_cache.get(token)
+    if username is None:
+        try:
+            payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        except JWTError:
+            return None
+        username = payload.get("sub")
+        if username is None:
+            return None
+        # A cached decode must never outlive the token itself
+        ttl = settings.auth_cache_ttl_seconds
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        token_cache.set(token, username, ttl)
+    return username
+
+
+def principal_key(username: str) -> str:
+    return f"auth:principal:{username}"
+
+
+async def load_principal(db: AsyncSession, username: str) -> Optional[User]:
+    """A detached User for username, from the local cache, Redis or the database"""
+    fields = principal_cache.get(username)
+    if fields is None and settings.auth_cache_redis:
+        cached = await async_redis_client.get(principal_key(username))
+        if cached:
+            fields = json.loads(cached)
+            if fields["created_at"]:
+                fields["created_at"] = datetime.fromisoformat(fields["created_at"])
+            principal_cache.set(username, fields)
+    if fields is None:
+        result = await db.execute(select(User).where(User.username == username))
+        user = result.scalar_one_or_none()
+        if user is None:
+            return None
+        fields = {name: getattr(user, name) for name in PRINCIPAL_FIELDS}
+        principal_cache.set(username, fields)
+        if settings.auth_cache_redis:
+            await async_redis_client.set(
+                principal_key(username), json.dumps(fields, default=datetime.isoformat),
+                ex=settings.auth_cache_ttl_seconds,
+            )
+    # A fresh instance per request, so callers can't alter the cached copy
+    return User(**fields)
+
+
+async def invalidate_principal(user_id: int, username: str):
+    """Forget a user's cached principal and profile on every worker"""
+    principal_cache.pop(username)
+    invalidate_user_profile(user_id)
+    if settings.auth_cache_redis:
+        await async_redis_client.delete(principal_key(username))
+    await async_redis_manager.publish_message(
+        AUTH_INVALIDATION_CHANNEL, {"user_id": user_id, "username": username}
+    )
+
+
+def on_principal_invalidated(data: str):
+    """Subscriber handler for invalidations published by other workers"""
+    event = json.loads(data)
+    principal_cache.pop(event["username"])
+    invalidate_user_profile(event["user_id"])
+
+
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -55,19 +135,27 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    token = credentials.credentials
-    token_data = verify_token(token, credentials_exception)
+    username = decode_token_subject(credentials.credentials)
+    if username is None:
+        raise credentials_exception
     
-    user = db.query(User).filter(User.username == token_data.username).first()
+    user = await load_principal(db, username)
     if user is None:
         raise credentials_exception
     return user
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalar_one_or_none()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    # bcrypt is CPU-bound; it runs on the password hashing process pool
+    verified, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash is not None:
+        # The cost settings changed since this hash was made
+        user.hashed_password = new_hash
+        await db.commit()
     return user
@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from models import User, Message
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ttl seconds after being set"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# Public profile fields by user id, shared by every online-user listing
+user_profile_cache = TTLCache(settings.user_cache_max_size, settings.user_cache_ttl_seconds)
+
+# Ids of everyone a user has exchanged messages with
+contact_cache = TTLCache(settings.user_cache_max_size, settings.contact_cache_ttl_seconds)
+
+# Ids per IN query; asyncpg caps a statement at 32767 bind parameters
+PROFILE_BATCH_SIZE = 1000
+
+
+async def get_user_profiles(db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, dict]:
+    """Profiles for user_ids, loading cache misses with batched IN queries"""
+    profiles = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        profile = user_profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+
+    for start in range(0, len(missing), PROFILE_BATCH_SIZE):
+        batch = missing[start:start + PROFILE_BATCH_SIZE]
+        result = await db.execute(select(User.id, User.username).where(User.id.in_(batch)))
+        for user_id, username in result:
+            profile = {"id": user_id, "username": username}
+            user_profile_cache.set(user_id, profile)
+            profiles[user_id] = profile
+    return profiles
+
+
+def invalidate_user_profile(user_id: int):
+    """Forget a cached profile after the user changes it"""
+    user_profile_cache.pop(user_id)
+
+
+async def get_contact_ids(db: AsyncSession, user_id: int) -> Set[int]:
+    """Ids of users who share a conversation with user_id"""
+    contacts = contact_cache.get(user_id)
+    if contacts is None:
+        result = await db.execute(
+            select(Message.receiver_id).where(Message.sender_id == user_id).union(
+                select(Message.sender_id).where(Message.receiver_id == user_id)
+            )
+        )
+        contacts = set(result.scalars().all())
+        contact_cache.set(user_id, contacts)
+    return contacts
+
+
+def note_contact(user_id: int, partner_id: int):
+    """Record a new conversation in both users' cached contact sets"""
+    for owner, contact in ((user_id, partner_id), (partner_id, user_id)):
+        contacts = contact_cache.get(owner)
+        if contacts is not None:
+            contacts.add(contact)
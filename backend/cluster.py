@@ -0,0 +1,40 @@
+import os
+import socket
+import uuid
+from typing import Iterable, List, Optional, Tuple
+from config import settings
+
+# Identifies this process in the cluster. Every connection id starts with it,
+# so the presence registry (presence:user:{id} -> connection ids) doubles as
+# a map of which workers hold each user's sockets.
+WORKER_ID = settings.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def new_connection_id(worker_id: str = WORKER_ID) -> str:
+    return f"{worker_id}:{uuid.uuid4().hex}"
+
+
+def connection_worker(connection_id: str) -> Optional[str]:
+    """The worker holding a connection, or None for ids without one"""
+    worker_id, separator, _ = connection_id.rpartition(":")
+    return worker_id if separator else None
+
+
+# Worker and room channel payloads are "{user_id},{user_id},... {type}\n{event
+# json}". JSON output never contains a raw newline, and the event type rides
+# in the header, so workers route the event to sockets as-is without parsing
+# or re-serializing it.
+
+def pack_delivery(user_ids: Iterable[int], payload: str, event_type: Optional[str] = None) -> str:
+    header = ",".join(str(user_id) for user_id in user_ids)
+    if event_type:
+        header = f"{header} {event_type}"
+    return header + "\n" + payload
+
+
+def unpack_delivery(data: str) -> Tuple[List[int], str, Optional[str]]:
+    """Recipients, payload and event type (None if the sender didn't include it)"""
+    header, payload = data.split("\n", 1)
+    recipients, _, event_type = header.partition(" ")
+    user_ids = [int(user_id) for user_id in recipients.split(",") if user_id]
+    return user_ids, payload, event_type or None
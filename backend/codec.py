@@ -0,0 +1,61 @@
+import json
+from functools import lru_cache
+from typing import Any, Union
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+# Serialization for WebSocket frames and Redis payloads. orjson is used when
+# installed and the standard library otherwise; both write compact JSON with
+# no raw newlines, which the delivery framing in cluster.py relies on.
+#
+# Clients that open the socket with the "msgpack" subprotocol get binary
+# MessagePack frames instead. Payloads stay JSON all the way through Redis
+# and the outbound queues, and are only converted when written to such a
+# socket, once per payload however many sockets receive it.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+# Default class for REST responses
+response_class = ORJSONResponse if orjson is not None else JSONResponse
+
+
+def dumps(obj: Any) -> str:
+    """Encode obj as compact JSON text"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Decode JSON text or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def msgpack_available() -> bool:
+    return msgpack is not None
+
+
+@lru_cache(maxsize=1024)
+def json_to_msgpack(payload: str) -> bytes:
+    """Re-encode a JSON payload for a MessagePack socket.
+
+    Cached so an event fanned out to many MessagePack sockets is converted
+    once; the payload string is the same object for every recipient.
+    """
+    return msgpack.packb(loads(payload))
+
+
+def unpack_msgpack(data: bytes) -> Any:
+    """Decode a frame sent by a MessagePack client"""
+    return msgpack.unpackb(data)
@@ -0,0 +1,56 @@
+from typing import Dict, Iterable, Tuple
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Conversation
+
+# Characters of the last message kept for the inbox listing
+PREVIEW_LENGTH = 100
+
+MESSAGE_FIELDS = ("id", "sender_id", "receiver_id", "content", "created_at")
+
+
+async def record_messages(db: AsyncSession, messages: Iterable) -> int:
+    """Point both participants' inbox entries at the newest of these messages.
+
+    Accepts Message objects or row dicts, so the write-behind batcher can pass
+    a whole batch: only the latest message per pair is written, in one upsert
+    that never moves an entry back to an older message. Runs in the caller's
+    transaction and does not commit. Returns the number of entries written.
+    """
+    latest: Dict[Tuple[int, int], dict] = {}
+    for message in messages:
+        row = message if isinstance(message, dict) else {
+            name: getattr(message, name) for name in MESSAGE_FIELDS
+        }
+        for user_id, partner_id in (
+            (row["sender_id"], row["receiver_id"]),
+            (row["receiver_id"], row["sender_id"]),
+        ):
+            current = latest.get((user_id, partner_id))
+            if current is None or row["id"] > current["last_message_id"]:
+                latest[(user_id, partner_id)] = {
+                    "user_id": user_id,
+                    "partner_id": partner_id,
+                    "last_message_id": row["id"],
+                    "last_sender_id": row["sender_id"],
+                    "last_message_preview": row["content"][:PREVIEW_LENGTH],
+                    "last_message_at": row["created_at"],
+                }
+    if not latest:
+        return 0
+    
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    statement = insert(Conversation).values(list(latest.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[Conversation.user_id, Conversation.partner_id],
+        set_={
+            "last_message_id": statement.excluded.last_message_id,
+            "last_sender_id": statement.excluded.last_sender_id,
+            "last_message_preview": statement.excluded.last_message_preview,
+            "last_message_at": statement.excluded.last_message_at,
+        },
+        where=Conversation.last_message_id < statement.excluded.last_message_id,
+    )
+    await db.execute(statement)
+    return len(latest)
@@ -0,0 +1,44 @@
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Set
+import codec
+from cluster import connection_worker, pack_delivery
+from event_streams import append_event
+from presence import presence
+from redis_client import redis_manager, async_redis_manager
+
+
+async def deliver_to_users(
+    user_ids: Iterable[int], event: Dict[str, Any], replayable: bool = False
+) -> int:
+    """Deliver an event to every live connection of the given users, cluster-wide.
+
+    Presence records which worker holds each connection, so the event is
+    serialized once and published once per worker that has a recipient, all
+    in a single pipelined round trip. Offline recipients are skipped. Returns
+    the number of workers published to.
+    
+    Replayable events are first appended to every recipient's event stream,
+    offline or not, and carry an event_id. Appending before presence is read
+    means a socket connecting concurrently either sees the event in its
+    replay or is already registered to receive it live.
+    """
+    user_ids = list(user_ids)
+    payload = codec.dumps(event)
+    if replayable:
+        payload = await append_event(user_ids, payload)
+    
+    connections = await presence.connections(user_ids)
+    recipients: Dict[str, Set[int]] = defaultdict(set)
+    for user_id, connection_ids in connections.items():
+        for connection_id in connection_ids:
+            worker_id = connection_worker(connection_id)
+            if worker_id is not None:
+                recipients[worker_id].add(user_id)
+    if not recipients:
+        return 0
+    
+    await async_redis_manager.publish_many(
+        (redis_manager.get_worker_channel(worker_id), pack_delivery(user_ids, payload, event["type"]))
+        for worker_id, user_ids in recipients.items()
+    )
+    return len(recipients)
@@ -0,0 +1,78 @@
+from typing import Iterable, List, Optional, Tuple
+from config import settings
+from redis_client import async_redis_client
+
+# Replayable events are appended to a capped Redis Stream per recipient,
+# events:{user_id}, before they are published. A reconnecting client sends
+# the last event_id it saw and is replayed what it missed from its stream,
+# instead of refetching its conversations from the database.
+#
+# Event ids come from one global counter, so an event delivered to several
+# users carries the same id everywhere and its payload is still serialized
+# once. Each entry also records the id of the entry before it in that
+# user's stream, which is how a replay tells "nothing happened" apart from
+# "older entries were trimmed or expired".
+
+SEQUENCE_KEY = "events:id_seq"
+
+# KEYS[1] = id counter, KEYS[2..] = recipient streams
+# ARGV[1] = event JSON object, ARGV[2] = MAXLEN, ARGV[3] = TTL in seconds
+# Returns the payload with its "event_id" spliced in
+APPEND_SCRIPT = """
+local id = redis.call('INCR', KEYS[1])
+local payload = string.sub(ARGV[1], 1, -2) .. ',"event_id":' .. id .. '}'
+for i = 2, #KEYS do
+    local last = redis.call('XREVRANGE', KEYS[i], '+', '-', 'COUNT', 1)
+    local prev = '0'
+    if #last > 0 then
+        prev = string.match(last[1][1], '^(%d+)')
+    end
+    redis.call('XADD', KEYS[i], 'MAXLEN', '~', ARGV[2], id .. '-0', 'prev', prev, 'event', payload)
+    redis.call('EXPIRE', KEYS[i], ARGV[3])
+end
+return payload
+"""
+
+
+def stream_key(user_id: int) -> str:
+    return f"events:{user_id}"
+
+
+_append = async_redis_client.register_script(APPEND_SCRIPT)
+
+
+async def append_event(user_ids: Iterable[int], payload: str) -> str:
+    """Add a serialized event to each user's stream; returns it with its event_id"""
+    keys = [stream_key(user_id) for user_id in sorted(set(user_ids))]
+    return await _append(
+        keys=[SEQUENCE_KEY, *keys],
+        args=[payload, settings.event_stream_maxlen, settings.event_stream_ttl_seconds],
+    )
+
+
+async def events_since(user_id: int, last_event_id: int, limit: int) -> Optional[List[Tuple[int, str]]]:
+    """(event_id, payload) pairs a user missed after last_event_id, oldest first.
+
+    Returns None when the stream can no longer prove it holds everything
+    since then (entries trimmed or the stream expired), or when more than
+    limit events were missed; the client must then resync from the REST
+    endpoints.
+    """
+    entries = await async_redis_client.xrange(
+        stream_key(user_id), min=f"{last_event_id + 1}-0", max="+", count=limit + 1
+    )
+    if not entries:
+        # Nothing newer, but only trustworthy if the stream still reaches back
+        # to last_event_id
+        newest = await async_redis_client.xrevrange(stream_key(user_id), count=1)
+        if newest and entry_event_id(newest[0][0]) == last_event_id:
+            return []
+        return None
+    if len(entries) > limit or int(entries[0][1]["prev"]) != last_event_id:
+        return None
+    return [(entry_event_id(entry_id), fields["event"]) for entry_id, fields in entries]
+
+
+def entry_event_id(entry_id: str) -> int:
+    """The event id of a stream entry id ("{event_id}-0")"""
+    return int(entry_id.split("-", 1)[0])
@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
 """
-Initialize the database with sample data
+Initialize the database with sample data; run `alembic upgrade head` first
 """
-from database import engine, SessionLocal
-from models import Base, User
+from database import SessionLocal
+from models import User
 from auth import get_password_hash
 import json
 
 def init_db():
-    # Create tables
-    Base.metadata.create_all(bind=engine)
-    
     db = SessionLocal()
     
     try:
@@ -1,38 +1,59 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import json
 import asyncio
 from contextlib import asynccontextmanager
+from typing import Optional
 
 from config import settings
-from database import engine, Base
-from routers import auth, messages, users
-from websocket_manager import manager
-from redis_client import redis_manager
-from auth import get_current_user
+import codec
+from pydantic import ValidationError
+from database import AsyncSessionLocal
+from routers import auth, messages, users, conversations, rooms
+from websocket_manager import manager, Connection
+from redis_subscriber import subscriber
+from presence import presence
+from redis_client import async_redis_manager
+from cache import user_profile_cache, get_user_profiles
+from message_writer import message_writer
+from recent_messages import recent_messages
+from password_hashing import password_hasher
+from auth import (
+    get_current_user, decode_token_subject, load_principal,
+    AUTH_INVALIDATION_CHANNEL, on_principal_invalidated, principal_cache, token_cache,
+)
 from models import User
-from schemas import TypingIndicator
-
-
-# Create tables
-Base.metadata.create_all(bind=engine)
+from schemas import MessageCreate
+from messaging import (
+    send_chat_message, claim_client_id, lookup_client_id, release_client_id,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("Starting up...")
+    await subscriber.start()
+    await subscriber.subscribe(AUTH_INVALIDATION_CHANNEL, on_principal_invalidated)
+    await manager.start()
+    await message_writer.start()
+    password_hasher.start()
     yield
     # Shutdown
     print("Shutting down...")
+    await manager.stop()
+    await message_writer.stop()
+    password_hasher.stop()
+    await subscriber.stop()
+    await async_redis_manager.close()
 
 
 app = FastAPI(
     title="Chat App API",
     description="Real-time chat application with WebSockets and Redis",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=codec.response_class
 )
 
 # CORS middleware
@@ -48,6 +69,8 @@ app.add_middleware(
 app.include_router(auth.router)
 app.include_router(messages.router)
 app.include_router(users.router)
+app.include_router(conversations.router)
+app.include_router(rooms.router)
 
 
 @app.get("/")
@@ -55,68 +78,139 @@ def read_root():
     return {"message": "Chat App API is running!"}
 
 
+async def receive_client_messages(connection: Connection, user: User):
+    """Handle frames sent by the client until it disconnects"""
+    while True:
+        message_data = await connection.receive()
+        
+        if message_data.get("type") == "message":
+            await receive_chat_message(connection, user, message_data)
+        
+        elif message_data.get("type") == "presence_subscribe":
+            # Follow presence of users outside the client's conversations
+            user_ids = [
+                user_id for user_id in message_data.get("user_ids", [])
+                if isinstance(user_id, int)
+            ][:settings.presence_watch_max_users]
+            await presence.watch(user.id, user_ids)
+        
+        elif message_data.get("type") == "typing":
+            # Coalesced and rate limited per connection before it goes out
+            chat_partner_id = message_data.get("chat_partner_id")
+            if isinstance(chat_partner_id, int) and chat_partner_id != user.id:
+                await manager.update_typing(
+                    connection, chat_partner_id, bool(message_data.get("is_typing"))
+                )
+
+
+async def receive_chat_message(connection: Connection, user: User, frame: dict):
+    """Send a chat message from a WebSocket frame and ack it on the same socket.
+    
+    The socket is already authenticated, so this skips the bearer check and
+    user lookup a REST send pays for. A client_id in the frame makes retries
+    idempotent: a repeated id is acked with the original message id instead of
+    being stored again.
+    """
+    client_id = frame.get("client_id")
+    if client_id is not None:
+        client_id = str(client_id)[:64]
+    
+    def reply(event: dict):
+        connection.enqueue(codec.dumps({**event, "client_id": client_id}), event["type"])
+    
+    try:
+        message = MessageCreate(content=frame.get("content"), receiver_id=frame.get("receiver_id"))
+    except ValidationError:
+        reply({"type": "error", "detail": "Invalid message"})
+        return
+    
+    if client_id is not None and not await claim_client_id(user.id, client_id):
+        message_id = await lookup_client_id(user.id, client_id)
+        reply({"type": "ack", "id": message_id, "duplicate": True})
+        return
+    
+    try:
+        async with AsyncSessionLocal() as db:
+            profiles = await get_user_profiles(db, [message.receiver_id])
+            receiver = profiles.get(message.receiver_id)
+            if receiver is None:
+                if client_id is not None:
+                    await release_client_id(user.id, client_id)
+                reply({"type": "error", "detail": "Receiver not found"})
+                return
+            db_message, _ = await send_chat_message(
+                db, user.id, user.username, receiver["id"], receiver["username"],
+                message.content, client_id,
+            )
+    except Exception as e:
+        print(f"Error sending message from user {user.id}: {e}")
+        # Once stored the claim points at the message; keep it so a retry is
+        # acked as a duplicate instead of storing the message twice
+        if client_id is not None and await lookup_client_id(user.id, client_id) is None:
+            await release_client_id(user.id, client_id)
+        reply({"type": "error", "detail": "Message could not be sent"})
+        return
+    
+    reply({
+        "type": "ack",
+        "id": db_message.id,
+        "created_at": db_message.created_at.isoformat(),
+        "duplicate": False,
+    })
+
+
 @app.websocket("/ws/{token}")
-async def websocket_endpoint(websocket: WebSocket, token: str):
-    # In a real app, you'd validate the JWT token here
-    # For now, we'll extract user info from token (simplified)
+async def websocket_endpoint(websocket: WebSocket, token: str, last_event_id: Optional[int] = None):
+    # The token is checked exactly like a bearer header on REST routes
     try:
-        # This is a simplified approach - in production, properly validate JWT
-        from jose import jwt
-        from config import settings
-        
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
-        username = payload.get("sub")
+        username = decode_token_subject(token)
         
         if not username:
             await websocket.close(code=1008, reason="Invalid token")
             return
             
-        # Get user from database
-        from database import SessionLocal
-        db = SessionLocal()
-        user = db.query(User).filter(User.username == username).first()
-        db.close()
+        # Get user from the principal cache, falling back to the database
+        async with AsyncSessionLocal() as db:
+            user = await load_principal(db, username)
         
         if not user:
             await websocket.close(code=1008, reason="User not found")
             return
             
-        await manager.connect(websocket, user.id, user.username)
-        
-        # Send online users list to the newly connected user
-        await manager.broadcast_online_users(user.id)
-        
-        # Listen for Redis messages
-        pubsub = redis_manager.subscribe_to_channel(f"user:{user.id}")
+        # A reconnecting client passes the last event_id it saw to get what it missed
+        connection = await manager.connect(websocket, user.id, user.username, last_event_id)
         
         try:
-            while True:
-                # Check for Redis messages
-                message = pubsub.get_message(timeout=0.1)
-                if message and message['type'] == 'message':
-                    data = json.loads(message['data'])
-                    await websocket.send_text(json.dumps(data))
-                
-                # Check for WebSocket messages from client
-                try:
-                    data = await asyncio.wait_for(websocket.receive_text(), timeout=0.1)
-                    message_data = json.loads(data)
-                    
-                    if message_data.get("type") == "typing":
-                        # Handle typing indicator
-                        typing_data = message_data
-                        chat_partner_id = typing_data.get("chat_partner_id")
-                        if chat_partner_id:
-                            await manager.send_typing_indicator(
-                                typing_data, user.id, chat_partner_id
-                            )
-                    
-                except asyncio.TimeoutError:
-                    pass
-                    
-        except WebSocketDisconnect:
-            manager.disconnect(user.id)
-            pubsub.close()
+            # Send online users list to the newly connected user
+            await manager.broadcast_online_users(user.id)
+            
+            # One task drains the connection's outbound queue to the socket, the
+            # other handles client frames; both sleep until there is work, so idle
+            # sockets are free
+            writer = asyncio.create_task(connection.run_writer())
+            reader = asyncio.create_task(receive_client_messages(connection, user))
+            evicted = asyncio.create_task(connection.evicted.wait())
+            
+            done, pending = await asyncio.wait(
+                {reader, writer, evicted}, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                    print(f"WebSocket task error: {task.exception()}")
+        finally:
+            await manager.disconnect(connection)
+        
+        if evicted in done:
+            # Slow consumer: don't wait forever on a socket that isn't draining
+            try:
+                await asyncio.wait_for(
+                    websocket.close(code=1013, reason="Slow consumer"), timeout=5
+                )
+            except Exception as e:
+                print(f"Error closing evicted WebSocket: {e}")
             
     except Exception as e:
         print(f"WebSocket error: {e}")
@@ -128,6 +222,22 @@ def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics")
+def metrics():
+    return {
+        "connections": manager.stats(),
+        "subscriber": subscriber.stats(),
+        "user_profile_cache": user_profile_cache.stats(),
+        "message_writer": message_writer.stats(),
+        "recent_messages": recent_messages.stats(),
+        "password_hasher": password_hasher.stats(),
+        "auth_cache": {
+            "tokens": token_cache.stats(),
+            "principals": principal_cache.stats(),
+        },
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import Dict, List, Optional
+from fastapi import HTTPException, status
+from sqlalchemy import select, func, text
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from config import settings
+from conversations import record_messages
+from database import AsyncSessionLocal
+from models import Message, utcnow
+from redis_client import async_redis_client
+
+# Write-behind ingestion. Ids come from a Redis counter so a message can be
+# published before its row exists; rows are buffered in-process and written
+# with one multi-row INSERT per batch.
+#
+# Durability (MESSAGE_DURABILITY):
+#   journal - each message is also stored in the messages:journal hash in the
+#             same round trip as its id. A crashed worker's unflushed rows are
+#             inserted by the next worker that starts, so nothing acknowledged
+#             is lost as long as Redis persists (AOF).
+#   memory  - nothing leaves the process until the batch is flushed; a crash
+#             loses up to MESSAGE_FLUSH_MS worth of messages.
+#
+# The buffer is capped at MESSAGE_BUFFER_MAX rows; past that, sends fail fast
+# with a 503 instead of being acknowledged while the database is down. A
+# batch the database refuses is retried row by row: rows it rejects on their
+# own (constraint or data errors) are moved to the messages:dead_letter hash
+# so they can't hold up everything behind them, while any other error leaves
+# the rest buffered for the next attempt.
+#
+# Inserts use ON CONFLICT (id) DO NOTHING, so replaying a journal entry that
+# was already flushed is harmless. Every worker must run in the same mode:
+# the Redis counter and the table's own sequence would otherwise hand out
+# the same ids.
+
+SEQUENCE_KEY = "messages:id_seq"
+JOURNAL_KEY = "messages:journal"
+DEAD_LETTER_KEY = "messages:dead_letter"
+
+# Errors that condemn a single row rather than the database connection
+POISON_ERRORS = (IntegrityError, DataError)
+
+# Returns nil when the counter is missing (never seeded, or Redis lost it)
+ALLOCATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local id = redis.call('INCR', KEYS[1])
+if ARGV[1] ~= '' then
+    redis.call('HSET', KEYS[2], id, ARGV[1])
+end
+return id
+"""
+
+SEED_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current or tonumber(current) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+class MessageWriter:
+    """Buffers new messages and persists them in batches"""
+
+    def __init__(self):
+        self.redis = async_redis_client
+        self.enabled = settings.message_write_behind
+        self.batch_size = settings.message_batch_size
+        self.flush_seconds = settings.message_flush_ms / 1000
+        self.max_buffered = settings.message_buffer_max
+        self.journal = settings.message_durability == "journal"
+        self._allocate = self.redis.register_script(ALLOCATE_SCRIPT)
+        self._seed = self.redis.register_script(SEED_SCRIPT)
+        self.buffer: List[Dict] = []
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # Counters
+        self.flushed = 0
+        self.batches = 0
+        self.failed_flushes = 0
+        self.recovered = 0
+        self.rejected = 0
+        self.dead_lettered = 0
+
+    async def start(self):
+        """Replay the crash journal, seed the id counter and start the batcher"""
+        if not self.enabled or self._task is not None:
+            return
+        await self.recover()
+        await self._seed_counter()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the batcher and write out whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def submit(self, sender_id: int, receiver_id: int, content: str) -> Message:
+        """Assign an id and queue the row; returns a transient Message to publish"""
+        if len(self.buffer) >= self.max_buffered:
+            # The database is down or falling behind; don't ack what can't be stored
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Messages are backing up, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        row = {
+            "content": content,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "is_read": False,
+            "created_at": utcnow(),
+        }
+        entry = json.dumps({**row, "created_at": row["created_at"].isoformat()}) if self.journal else ""
+        message_id = await self._allocate(keys=[SEQUENCE_KEY, JOURNAL_KEY], args=[entry])
+        if message_id is None:
+            await self._seed_counter()
+            message_id = await self._allocate(keys=[SEQUENCE_KEY, JOURNAL_KEY], args=[entry])
+        row["id"] = int(message_id)
+
+        self.buffer.append(row)
+        self._pending.set()
+        if len(self.buffer) >= self.batch_size:
+            self._full.set()
+        return Message(**row)
+
+    async def flush(self) -> bool:
+        """Write every buffered row; returns False if the database refused a batch"""
+        async with self._flush_lock:
+            while self.buffer:
+                rows = self.buffer[:self.batch_size]
+                settled = len(rows)
+                dead_lettered = self.dead_lettered
+                try:
+                    await self._insert(rows)
+                    self.batches += 1
+                except Exception as e:
+                    print(f"Error flushing {len(rows)} messages: {e}")
+                    self.failed_flushes += 1
+                    settled = await self._insert_each(rows)
+                del self.buffer[:settled]
+                if self.journal and settled:
+                    await self.redis.hdel(JOURNAL_KEY, *[row["id"] for row in rows[:settled]])
+                self.flushed += settled - (self.dead_lettered - dead_lettered)
+                if settled < len(rows):
+                    # The rest stay buffered (and journaled) for the next attempt
+                    return False
+            self._pending.clear()
+            self._full.clear()
+            return True
+
+    async def recover(self):
+        """Insert rows a crashed worker journaled but never flushed"""
+        entries = await self.redis.hgetall(JOURNAL_KEY)
+        if not entries:
+            return
+        rows = []
+        for message_id, entry in entries.items():
+            row = json.loads(entry)
+            row["id"] = int(message_id)
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+            rows.append(row)
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                await self._insert(batch)
+            except Exception as e:
+                print(f"Error recovering {len(batch)} messages: {e}")
+                if await self._insert_each(batch) < len(batch):
+                    raise
+            await self.redis.hdel(JOURNAL_KEY, *[row["id"] for row in batch])
+        self.recovered += len(rows)
+        print(f"Recovered {len(rows)} journaled messages")
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            # Let the batch fill for up to flush_ms unless it is already full
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            if not await self.flush():
+                await asyncio.sleep(1)
+
+    async def _insert_each(self, rows: List[Dict]) -> int:
+        """Insert a refused batch one row at a time; returns how many leading
+        rows are settled, either stored or dead-lettered
+        """
+        for index, row in enumerate(rows):
+            try:
+                await self._insert([row])
+            except POISON_ERRORS as e:
+                await self._dead_letter(row, e)
+            except Exception as e:
+                print(f"Error flushing message {row['id']}: {e}")
+                return index
+        return len(rows)
+
+    async def _dead_letter(self, row: Dict, error: Exception):
+        """Set aside a row the database will never accept"""
+        print(f"Dead-lettering message {row['id']}: {error}")
+        await self.redis.hset(DEAD_LETTER_KEY, row["id"], json.dumps({
+            **row, "created_at": row["created_at"].isoformat(), "error": str(error),
+        }))
+        self.dead_lettered += 1
+
+    async def _insert(self, rows: List[Dict]):
+        async with AsyncSessionLocal() as db:
+            is_postgresql = db.bind.dialect.name == "postgresql"
+            insert = postgresql_insert if is_postgresql else sqlite_insert
+            await db.execute(
+                insert(Message).values(rows).on_conflict_do_nothing(index_elements=[Message.id])
+            )
+            await record_messages(db, rows)
+            if is_postgresql:
+                # Keep the serial sequence ahead of Redis-assigned ids so the
+                # synchronous path can be switched back on safely
+                await db.execute(
+                    text(
+                        "SELECT setval(seq, :max_id) FROM "
+                        "(SELECT pg_get_serial_sequence('messages', 'id')::regclass AS seq) s "
+                        "WHERE :max_id > coalesce(pg_sequence_last_value(seq), 0)"
+                    ),
+                    {"max_id": max(row["id"] for row in rows)},
+                )
+            await db.commit()
+
+    async def _seed_counter(self):
+        """Move the id counter past every id already used or journaled"""
+        async with AsyncSessionLocal() as db:
+            highest = await db.scalar(select(func.max(Message.id))) or 0
+        journaled = await self.redis.hkeys(JOURNAL_KEY)
+        highest = max([highest, *(int(message_id) for message_id in journaled),
+                       *(row["id"] for row in self.buffer)])
+        await self._seed(keys=[SEQUENCE_KEY], args=[highest])
+
+    def stats(self) -> dict:
+        """Counters for the write-behind batcher"""
+        return {
+            "enabled": self.enabled,
+            "durability": "journal" if self.journal else "memory",
+            "buffered": len(self.buffer),
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failed_flushes": self.failed_flushes,
+            "recovered": self.recovered,
+            "rejected": self.rejected,
+            "dead_lettered": self.dead_lettered,
+        }
+
+
+message_writer = MessageWriter()
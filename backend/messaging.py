@@ -0,0 +1,94 @@
+from typing import Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import note_contact
+from conversations import record_messages
+from config import settings
+from delivery import deliver_to_users
+from message_writer import message_writer
+from models import Message
+from recent_messages import recent_messages
+from redis_client import async_redis_client
+from search import index_message
+from unread_counters import unread_counters
+
+
+async def send_chat_message(
+    db: AsyncSession,
+    sender_id: int,
+    sender_username: str,
+    receiver_id: int,
+    receiver_username: str,
+    content: str,
+    client_id: Optional[str] = None,
+) -> Tuple[Message, dict]:
+    """Store a message and deliver it to both participants.
+
+    Shared by POST /messages/ and the WebSocket "message" frame; callers have
+    already authenticated the sender and checked that the receiver exists.
+    Returns the stored message and the event that was delivered. A
+    client_id claimed by the caller is pointed at the message as soon as it
+    is stored, before anything else that could fail.
+    """
+    if message_writer.enabled:
+        # Published now, persisted by the next batch
+        db_message = await message_writer.submit(sender_id, receiver_id, content)
+    else:
+        db_message = Message(content=content, sender_id=sender_id, receiver_id=receiver_id)
+        db.add(db_message)
+        await db.flush()
+        # The inbox entries commit with the message
+        await record_messages(db, [db_message])
+        await db.commit()
+        await db.refresh(db_message)
+    if client_id is not None:
+        # Stored: from here on a retry must be acked, not stored again
+        await remember_client_id(sender_id, client_id, db_message.id)
+    note_contact(sender_id, receiver_id)
+    await unread_counters.increment(receiver_id, sender_id, db_message.id)
+    index_message(db_message)
+    await recent_messages.append(db_message)
+
+    # Deliver to the receiver and to the sender's other open sessions
+    message_data = {
+        "type": "message",
+        "id": db_message.id,
+        "content": db_message.content,
+        "sender_id": db_message.sender_id,
+        "receiver_id": db_message.receiver_id,
+        "sender_username": sender_username,
+        "receiver_username": receiver_username,
+        "is_read": db_message.is_read,
+        "created_at": db_message.created_at.isoformat()
+    }
+    if client_id is not None:
+        # Lets the sender's sessions match the event to their optimistic copy
+        message_data["client_id"] = client_id
+    await deliver_to_users([receiver_id, sender_id], message_data, replayable=True)
+    return db_message, message_data
+
+
+def client_id_key(sender_id: int, client_id: str) -> str:
+    return f"client_message:{sender_id}:{client_id}"
+
+
+async def claim_client_id(sender_id: int, client_id: str) -> bool:
+    """Reserve a client-generated id; False if that send was already accepted"""
+    return bool(await async_redis_client.set(
+        client_id_key(sender_id, client_id), "", nx=True, ex=settings.message_dedupe_ttl_seconds
+    ))
+
+
+async def remember_client_id(sender_id: int, client_id: str, message_id: int):
+    """Record which message a claimed client id produced, for duplicate acks"""
+    await async_redis_client.set(client_id_key(sender_id, client_id), message_id, xx=True, keepttl=True)
+
+
+async def lookup_client_id(sender_id: int, client_id: str) -> Optional[int]:
+    """Message id an earlier send with this client id produced, if it finished"""
+    message_id = await async_redis_client.get(client_id_key(sender_id, client_id))
+    return int(message_id) if message_id else None
+
+
+async def release_client_id(sender_id: int, client_id: str):
+    """Forget a claim whose send failed so the client can retry it"""
+    await async_redis_client.delete(client_id_key(sender_id, client_id))
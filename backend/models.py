@@ -1,9 +1,37 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index, literal_column
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from sqlalchemy.sql.functions import GenericFunction
 from database import Base
 
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class least(GenericFunction):
+    type = Integer()
+    inherit_cache = True
+
+
+class greatest(GenericFunction):
+    type = Integer()
+    inherit_cache = True
+
+
+# SQLite spells LEAST/GREATEST as the multi-argument min()/max()
+@compiles(least, "sqlite")
+def _sqlite_least(element, compiler, **kw):
+    return "min(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(greatest, "sqlite")
+def _sqlite_greatest(element, compiler, **kw):
+    return "max(%s)" % compiler.process(element.clauses, **kw)
+
+
 class User(Base):
     __tablename__ = "users"
     
@@ -28,11 +56,90 @@ class Message(Base):
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     is_read = Column(Boolean, default=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Stamped app-side so every backend stores microseconds in one format,
+    # which keyset pagination on (created_at, id) relies on
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), default=utcnow)
     
     # Relationships
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+    
+    __table_args__ = (
+        # Full-text search; SQLite falls back to the in-process index in search_index.py
+        Index(
+            "ix_messages_content_fts",
+            func.to_tsvector(literal_column("'simple'"), content),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
+    
+    @classmethod
+    def conversation_filter(cls, user1_id: int, user2_id: int):
+        """Match both directions of a 1:1 chat through the canonical pair key"""
+        low, high = sorted((user1_id, user2_id))
+        return (func.least(cls.sender_id, cls.receiver_id) == low) & (
+            func.greatest(cls.sender_id, cls.receiver_id) == high
+        )
+    
+    @classmethod
+    def search_document(cls):
+        """Postgres tsvector of the content, matching ix_messages_content_fts"""
+        return func.to_tsvector(literal_column("'simple'"), cls.content)
+
+
+# Conversation history: (least, greatest) identifies the pair regardless of
+# direction, (created_at, id) is the keyset pagination order
+Index(
+    "ix_messages_conversation_created",
+    func.least(Message.sender_id, Message.receiver_id),
+    func.greatest(Message.sender_id, Message.receiver_id),
+    Message.created_at,
+    Message.id,
+)
+
+# Unread counts: only unread rows are indexed, so the index stays small
+Index(
+    "ix_messages_unread",
+    Message.receiver_id,
+    Message.sender_id,
+    postgresql_where=~Message.is_read,
+    sqlite_where=~Message.is_read,
+)
+
+# Everything a user sent or received, newest first (search, contact lists)
+Index("ix_messages_sender_created", Message.sender_id, Message.created_at, Message.id)
+Index("ix_messages_receiver_created", Message.receiver_id, Message.created_at, Message.id)
+
+
+class ReadWatermark(Base):
+    """Newest message id a user has read in each 1:1 conversation"""
+    __tablename__ = "read_watermarks"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    partner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class Conversation(Base):
+    """A user's inbox entry for one 1:1 chat partner, updated on every send"""
+    __tablename__ = "conversations"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    partner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+    last_sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    last_message_preview = Column(String, nullable=False)
+    last_message_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# Inbox listing: a user's conversations by last activity, keyset paginated
+Index(
+    "ix_conversations_user_last_message",
+    Conversation.user_id,
+    Conversation.last_message_at,
+    Conversation.last_message_id,
+)
 
 
 class ChatRoom(Base):
@@ -41,7 +148,34 @@ class ChatRoom(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     is_group = Column(Boolean, default=False)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    # For group chats, we'll use a separate table for room members
-    # For 1:1 chats, we'll create a room with both users
+    # Group chats list their members in room_members; 1:1 chats stay on
+    # messages.sender_id/receiver_id
+
+
+class RoomMember(Base):
+    __tablename__ = "room_members"
+    
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    joined_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# Rooms a user belongs to, loaded when their socket connects
+Index("ix_room_members_user", RoomMember.user_id)
+
+
+class RoomMessage(Base):
+    __tablename__ = "room_messages"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), default=utcnow)
+
+
+# Room history, keyset paginated on (created_at, id) like 1:1 conversations
+Index("ix_room_messages_room_created", RoomMessage.room_id, RoomMessage.created_at, RoomMessage.id)
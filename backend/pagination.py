@@ -0,0 +1,36 @@
+import base64
+from datetime import datetime
+from typing import Tuple
+from fastapi import HTTPException
+
+
+def encode_cursor(created_at: datetime, item_id: int) -> str:
+    """Opaque keyset cursor for a (created_at, id) position"""
+    raw = f"{created_at.isoformat()}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; rejects malformed cursors with a 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, item_id = base64.urlsafe_b64decode(padded.encode()).decode().rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(item_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_rank_cursor(rank: float, item_id: int) -> str:
+    """Opaque keyset cursor for a (rank, id) position in ranked results"""
+    raw = f"{rank!r}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_rank_cursor(cursor: str) -> Tuple[float, int]:
+    """Inverse of encode_rank_cursor; rejects malformed cursors with a 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, item_id = base64.urlsafe_b64decode(padded.encode()).decode().rsplit("|", 1)
+        return float(rank), int(item_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
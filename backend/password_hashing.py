@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from config import settings
+
+# Raising BCRYPT_ROUNDS marks existing hashes as needing an update; they are
+# rehashed transparently the next time their owner logs in
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds
+)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated process pool with a bounded backlog.
+
+    bcrypt costs 100-300 ms of CPU per call. Keeping it in its own processes
+    stops a login storm from starving the event loop and the threadpool, and
+    once max_pending calls are in flight new ones fail fast with a 503
+    instead of queueing without bound. A pool whose worker died is replaced
+    and the call retried once; if the new pool breaks too the call gets a 503.
+    """
+
+    def __init__(self):
+        self.workers = settings.password_hash_workers
+        self.max_pending = settings.password_hash_max_pending
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Counters
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.restarts = 0
+
+    def start(self):
+        if self._pool is None:
+            # Forking a process with a running event loop and open sockets is
+            # unsafe, so workers are spawned fresh
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def hash(self, password: str) -> str:
+        """Hash a new password with the current cost settings"""
+        return await self._run(_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Check a password; also returns a replacement hash if the stored one is outdated"""
+        verified, new_hash = await self._run(_verify_and_update, password, hashed_password)
+        if new_hash is not None:
+            self.rehashed += 1
+        return verified, new_hash
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-in requests, try again shortly",
+                headers={"Retry-After": str(settings.password_hash_retry_after_seconds)},
+            )
+        self.pending += 1
+        try:
+            for attempt in range(2):
+                self.start()
+                pool = self._pool
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+                except BrokenProcessPool as e:
+                    print(f"Password hashing pool broke (attempt {attempt + 1}): {e}")
+                    self._discard(pool)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Sign-in is temporarily unavailable, try again shortly",
+                headers={"Retry-After": str(settings.password_hash_retry_after_seconds)},
+            )
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def _discard(self, pool: ProcessPoolExecutor):
+        """Drop a broken pool so the next call spawns a new one; calls that
+        failed on the same pool only replace it once
+        """
+        if self._pool is pool:
+            self.stop()
+            self.restarts += 1
+
+    def stats(self) -> dict:
+        """Counters for the password hashing pool"""
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "restarts": self.restarts,
+        }
+
+
+password_hasher = PasswordHasher()
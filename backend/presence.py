@@ -0,0 +1,161 @@
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+from config import settings
+from redis_client import async_redis_client
+
+# Every live connection has an entry in presence:user:{id} scored by when its
+# heartbeat expires. The user also sits in one of the presence:shard:{n}
+# buckets, scored by the latest expiry of any of their connections, so a
+# crashed worker's users drop out on their own once heartbeats stop.
+
+CONNECT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local existing = redis.call('ZCARD', KEYS[1])
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[4], ARGV[2])
+return existing
+"""
+
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+SWEEP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+return expired
+"""
+
+
+class Presence:
+    """Sharded, heartbeat-based presence with per-connection reference counting"""
+
+    def __init__(self):
+        self.redis = async_redis_client
+        self.ttl = settings.presence_ttl_seconds
+        self.shards = settings.presence_shards
+        self._connect = self.redis.register_script(CONNECT_SCRIPT)
+        self._disconnect = self.redis.register_script(DISCONNECT_SCRIPT)
+        self._sweep = self.redis.register_script(SWEEP_SCRIPT)
+
+    def user_key(self, user_id: int) -> str:
+        return f"presence:user:{user_id}"
+
+    def shard_key(self, user_id: int) -> str:
+        return f"presence:shard:{int(user_id) % self.shards}"
+
+    async def connect(self, user_id: int, connection_id: str) -> bool:
+        """Register a connection; returns True if the user just came online"""
+        now = time.time()
+        existing = await self._connect(
+            keys=[self.user_key(user_id), self.shard_key(user_id)],
+            args=[connection_id, user_id, now, now + self.ttl, self.ttl * 2],
+        )
+        return existing == 0
+
+    async def disconnect(self, user_id: int, connection_id: str) -> bool:
+        """Drop a connection; returns True if it was the user's last one"""
+        went_offline = await self._disconnect(
+            keys=[self.user_key(user_id), self.shard_key(user_id)],
+            args=[connection_id, user_id, time.time()],
+        )
+        return went_offline == 1
+
+    async def heartbeat(self, connections: Iterable[Tuple[int, str]]):
+        """Extend the expiry of every (user_id, connection_id) pair in one round trip"""
+        expires_at = time.time() + self.ttl
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, connection_id in connections:
+                pipe.zadd(self.user_key(user_id), {connection_id: expires_at})
+                pipe.expire(self.user_key(user_id), self.ttl * 2)
+                pipe.zadd(self.shard_key(user_id), {str(user_id): expires_at}, gt=True)
+            await pipe.execute()
+
+    async def sweep(self) -> List[int]:
+        """Remove users whose heartbeats lapsed; returns the ids this call removed"""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                await self._sweep(keys=[f"presence:shard:{shard}"], args=[now], client=pipe)
+            results = await pipe.execute()
+        return [int(user_id) for expired in results for user_id in expired]
+
+    async def online_user_ids(self) -> Set[int]:
+        """All online user ids, read shard by shard"""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                pipe.zrangebyscore(f"presence:shard:{shard}", f"({now}", "+inf")
+            results = await pipe.execute()
+        return {int(user_id) for members in results for user_id in members}
+
+    async def filter_online(self, user_ids: Iterable[int]) -> List[int]:
+        """Return which of the given users are online in O(k), one round trip"""
+        by_shard: Dict[str, List[int]] = defaultdict(list)
+        for user_id in dict.fromkeys(user_ids):
+            by_shard[self.shard_key(user_id)].append(user_id)
+        if not by_shard:
+            return []
+
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, members in by_shard.items():
+                pipe.zmscore(key, [str(user_id) for user_id in members])
+            results = await pipe.execute()
+
+        online = []
+        for members, scores in zip(by_shard.values(), results):
+            online.extend(
+                user_id for user_id, score in zip(members, scores)
+                if score is not None and score > now
+            )
+        return online
+
+    async def connections(self, user_ids: Iterable[int]) -> Dict[int, List[str]]:
+        """Live connection ids of each online user among user_ids, one round trip"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrangebyscore(self.user_key(user_id), f"({now}", "+inf")
+            results = await pipe.execute()
+        return {
+            user_id: connection_ids
+            for user_id, connection_ids in zip(user_ids, results)
+            if connection_ids
+        }
+    
+    async def is_online(self, user_id: int) -> bool:
+        """Check if a single user is online"""
+        return bool(await self.filter_online([user_id]))
+
+    def watchers_key(self, user_id: int) -> str:
+        return f"presence:watchers:{user_id}"
+
+    async def watch(self, watcher_id: int, user_ids: Iterable[int]):
+        """Subscribe watcher_id to presence changes of user_ids"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.sadd(self.watchers_key(user_id), watcher_id)
+                pipe.expire(self.watchers_key(user_id), settings.presence_watch_ttl_seconds)
+            await pipe.execute()
+
+    async def watchers(self, user_id: int) -> Set[int]:
+        """Users who explicitly subscribed to user_id's presence"""
+        return {int(watcher_id) for watcher_id in await self.redis.smembers(self.watchers_key(user_id))}
+
+
+presence = Presence()
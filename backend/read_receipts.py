@@ -0,0 +1,86 @@
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from delivery import deliver_to_users
+from models import Message, ReadWatermark
+from unread_counters import unread_counters
+from message_writer import message_writer
+from recent_messages import recent_messages
+
+
+async def mark_conversation_read(
+    db: AsyncSession, reader_id: int, partner_id: int, up_to_id: int = None
+) -> dict:
+    """Mark everything partner_id sent reader_id up to up_to_id as read.
+
+    The pair's read watermark is checked first: a request it already covers
+    (re-opening a conversation, a repeated receipt) returns without writing
+    anything. Otherwise one UPDATE flips only the rows that are still unread
+    (via the partial unread index) and the watermark advances monotonically.
+    up_to_id is clamped to the newest message partner_id actually sent.
+    Commits, then sends the partner a single coalesced read_receipt event.
+    """
+    # Rows still buffered by write-behind would miss the UPDATE
+    await message_writer.flush()
+    
+    last_read_message_id = await db.scalar(
+        select(ReadWatermark.last_read_message_id).where(
+            ReadWatermark.user_id == reader_id, ReadWatermark.partner_id == partner_id
+        )
+    ) or 0
+    newest_id = await db.scalar(
+        select(func.max(Message.id)).where(
+            Message.receiver_id == reader_id, Message.sender_id == partner_id
+        )
+    )
+    if newest_id is None:
+        return {"marked_read": 0, "last_read_message_id": last_read_message_id}
+    up_to_id = newest_id if up_to_id is None else min(up_to_id, newest_id)
+    if up_to_id <= last_read_message_id:
+        return {"marked_read": 0, "last_read_message_id": last_read_message_id}
+    
+    result = await db.execute(
+        update(Message)
+        .where(
+            Message.receiver_id == reader_id,
+            Message.sender_id == partner_id,
+            ~Message.is_read,
+            Message.id <= up_to_id,
+        )
+        .values(is_read=True)
+    )
+    marked_read = result.rowcount
+    
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    statement = insert(ReadWatermark).values(
+        user_id=reader_id, partner_id=partner_id, last_read_message_id=up_to_id
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[ReadWatermark.user_id, ReadWatermark.partner_id],
+        set_={
+            "last_read_message_id": func.greatest(
+                ReadWatermark.last_read_message_id, statement.excluded.last_read_message_id
+            ),
+            "updated_at": func.now(),
+        },
+    )
+    last_read_message_id = await db.scalar(
+        statement.returning(ReadWatermark.last_read_message_id)
+    )
+    await db.commit()
+    
+    if marked_read:
+        await unread_counters.decrement(reader_id, partner_id, marked_read, up_to_id)
+        # Cached copies still show these messages as unread
+        await recent_messages.mark_read(reader_id, partner_id, up_to_id)
+        # One event per batch instead of one per message; the reader's other
+        # sessions use it to clear their unread badges
+        await deliver_to_users([partner_id, reader_id], {
+            "type": "read_receipt",
+            "reader_id": reader_id,
+            "partner_id": partner_id,
+            "up_to_id": up_to_id,
+            "count": marked_read,
+        }, replayable=True)
+    return {"marked_read": marked_read, "last_read_message_id": last_read_message_id}
@@ -0,0 +1,256 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import codec
+from config import settings
+from message_writer import message_writer
+from models import Message
+from redis_client import async_redis_client
+from pagination import decode_cursor
+
+# The newest RECENT_MESSAGES_CACHE_SIZE messages of each 1:1 conversation are
+# kept in a Redis list, recent:{low}:{high}, newest first. Sends push onto
+# lists that already exist; a read that finds no list loads it from the
+# database. Anything older than the window is read from the database.
+#
+# Read receipts flip is_read on the cached entries in place and bump the
+# pair's generation. A fill only lands if the generation is still the one
+# read before querying, so a slow reader can't put back rows that were
+# already out of date.
+#
+# A send that finds no list bumps the generation too: a fill already in
+# flight may have queried before the message committed. A send that lands
+# behind a newer message (two sends racing) drops the list rather than
+# pushing out of order.
+
+# Entries are JSON with "id" first, so scripts can read it without parsing
+# KEYS[1] = list, KEYS[2] = generation
+# ARGV[1] = message id, ARGV[2] = entry, ARGV[3] = cap, ARGV[4] = TTL in seconds
+APPEND_SCRIPT = """
+local head = redis.call('LINDEX', KEYS[1], 0)
+local head_id = head and tonumber(string.match(head, '^{"id":%s*(%d+)'))
+local id = tonumber(ARGV[1])
+if head_id and head_id < id then
+    redis.call('LPUSH', KEYS[1], ARGV[2])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+    return 1
+end
+if head_id == id then
+    return 0
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('DEL', KEYS[1])
+return 0
+"""
+
+# KEYS[1] = list, KEYS[2] = generation
+# ARGV[1] = reader, ARGV[2] = partner, ARGV[3] = newest id read, ARGV[4] = TTL
+# Entries are edited as text so "id" stays first
+MARK_READ_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+local reader, partner, up_to = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+local marked = 0
+for index, entry in ipairs(entries) do
+    local message = cjson.decode(entry)
+    if message.receiver_id == reader and message.sender_id == partner
+        and message.id <= up_to and message.is_read == false then
+        local from, to = string.find(entry, ',"is_read":false', 1, true)
+        if from then
+            entry = string.sub(entry, 1, from - 1) .. ',"is_read":true' .. string.sub(entry, to + 1)
+            redis.call('LSET', KEYS[1], index - 1, entry)
+            marked = marked + 1
+        end
+    end
+end
+return marked
+"""
+
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def _position(created_at: datetime, message_id: int) -> Tuple[datetime, int]:
+    """Sort key matching ORDER BY created_at, id; naive timestamps are UTC"""
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at, message_id
+
+
+def _message_position(message: Dict) -> Tuple[datetime, int]:
+    return _position(message["created_at"], message["id"])
+
+
+class RecentMessages:
+    """Capped per-conversation cache of the newest messages"""
+
+    def __init__(self):
+        self.redis = async_redis_client
+        self.size = settings.recent_messages_cache_size
+        self.ttl = settings.recent_messages_cache_ttl_seconds
+        self._append = self.redis.register_script(APPEND_SCRIPT)
+        self._fill = self.redis.register_script(FILL_SCRIPT)
+        self._mark_read = self.redis.register_script(MARK_READ_SCRIPT)
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    def _keys(self, user_id: int, partner_id: int) -> Tuple[str, str]:
+        low, high = sorted((user_id, partner_id))
+        return f"recent:{low}:{high}", f"recent:{low}:{high}:gen"
+
+    @staticmethod
+    def _serialize(message) -> str:
+        return codec.dumps({
+            "id": message.id,
+            "content": message.content,
+            "sender_id": message.sender_id,
+            "receiver_id": message.receiver_id,
+            "is_read": message.is_read,
+            "created_at": message.created_at.isoformat(),
+        })
+
+    @staticmethod
+    def _deserialize(entry: str) -> Dict:
+        message = codec.loads(entry)
+        message["created_at"] = datetime.fromisoformat(message["created_at"])
+        return message
+
+    async def append(self, message: Message):
+        """Push a new message onto its conversation's list, if that list is cached
+        and the message is newer than everything in it
+        """
+        key, generation_key = self._keys(message.sender_id, message.receiver_id)
+        await self._append(
+            keys=[key, generation_key],
+            args=[message.id, self._serialize(message), self.size, self.ttl],
+        )
+
+    async def mark_read(self, reader_id: int, partner_id: int, up_to_id: int):
+        """Show partner_id's cached messages to reader_id up to up_to_id as read,
+        and fence off fills that read them before the receipt
+        """
+        key, generation_key = self._keys(reader_id, partner_id)
+        await self._mark_read(
+            keys=[key, generation_key], args=[reader_id, partner_id, up_to_id, self.ttl]
+        )
+
+    async def window(
+        self, db: AsyncSession, user_id: int, partner_id: int, fill: bool = True
+    ) -> Optional[Tuple[List[Dict], bool, bool]]:
+        """The cached messages newest first, whether they are the whole
+        conversation, and whether they came from Redis.
+
+        On a miss the window is loaded from the database when fill is set,
+        otherwise None is returned.
+        """
+        key, generation_key = self._keys(user_id, partner_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.get(generation_key)
+            entries, generation = await pipe.execute()
+        if entries:
+            # Lists shorter than the cap hold the entire conversation
+            return [self._deserialize(entry) for entry in entries], len(entries) < self.size, True
+        if not fill:
+            return None
+
+        # Rows still buffered by write-behind would be missing from the fill
+        if message_writer.enabled:
+            await message_writer.flush()
+        result = await db.execute(
+            select(Message)
+            .where(Message.conversation_filter(user_id, partner_id))
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .limit(self.size)
+        )
+        rows = result.scalars().all()
+        if rows:
+            await self._fill(
+                keys=[key, generation_key],
+                args=[generation or "0", self.ttl, *(self._serialize(row) for row in rows)],
+            )
+        messages = [self._deserialize(self._serialize(row)) for row in rows]
+        return messages, len(messages) < self.size, False
+
+    async def history_page(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        partner_id: int,
+        before: Optional[str],
+        after: Optional[str],
+        limit: int,
+    ) -> Optional[Tuple[List[Dict], bool, bool]]:
+        """A /history page newest first with has_more and the hit flag, or
+        None when the page reaches past the cached window.
+        """
+        window = await self.window(db, user_id, partner_id, fill=not (before or after))
+        if window is None:
+            self.misses += 1
+            return None
+        messages, complete, hit = window
+
+        if after:
+            cursor = _position(*decode_cursor(after))
+            # Everything newer than the cursor is cached once the window reaches it
+            if not complete and (not messages or _message_position(messages[-1]) > cursor):
+                self.misses += 1
+                return None
+            newer = [m for m in messages if _message_position(m) > cursor]
+            page = newer[-limit:]
+            self._count(hit)
+            return page, len(newer) > limit, hit
+
+        if before:
+            cursor = _position(*decode_cursor(before))
+            messages = [m for m in messages if _message_position(m) < cursor]
+        if len(messages) > limit:
+            self._count(hit)
+            return messages[:limit], True, hit
+        if complete:
+            self._count(hit)
+            return messages, False, hit
+        self.misses += 1
+        return None
+
+    async def offset_page(
+        self, db: AsyncSession, user_id: int, partner_id: int, skip: int, limit: int
+    ) -> Optional[Tuple[List[Dict], bool]]:
+        """An offset page newest first with the hit flag, or None past the window"""
+        window = await self.window(db, user_id, partner_id, fill=skip == 0)
+        if window is not None:
+            messages, complete, hit = window
+            if complete or len(messages) >= skip + limit:
+                self._count(hit)
+                return messages[skip:skip + limit], hit
+        self.misses += 1
+        return None
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        """Counters for the recent-messages cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+recent_messages = RecentMessages()
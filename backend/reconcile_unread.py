@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Rebuild the Redis unread counters from the messages table
+"""
+import asyncio
+from database import AsyncSessionLocal
+from redis_client import async_redis_manager
+from unread_counters import unread_counters
+
+async def reconcile_unread():
+    try:
+        async with AsyncSessionLocal() as db:
+            users = await unread_counters.reconcile(db)
+        print(f"Reconciled unread counters for {users} users")
+    except Exception as e:
+        print(f"Error reconciling unread counters: {e}")
+    finally:
+        await async_redis_manager.close()
+
+if __name__ == "__main__":
+    asyncio.run(reconcile_unread())
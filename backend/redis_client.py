@@ -1,10 +1,21 @@
 import redis
-import json
-from typing import Dict, Any
+import redis.asyncio as aioredis
+from typing import Dict, Any, Iterable, Tuple
 from config import settings
+import codec
 
 redis_client = redis.from_url(settings.redis_url, decode_responses=True)
 
+# Shared, bounded pool for async callers: once max_connections are checked out,
+# callers wait up to redis_pool_timeout seconds instead of opening more sockets
+async_redis_pool = aioredis.BlockingConnectionPool.from_url(
+    settings.redis_url,
+    max_connections=settings.redis_max_connections,
+    timeout=settings.redis_pool_timeout,
+    decode_responses=True,
+)
+async_redis_client = aioredis.Redis(connection_pool=async_redis_pool)
+
 
 class RedisManager:
     def __init__(self):
@@ -12,40 +23,33 @@ class RedisManager:
     
     def publish_message(self, channel: str, message: Dict[str, Any]):
         """Publish a message to a Redis channel"""
-        self.redis.publish(channel, json.dumps(message))
-    
-    def subscribe_to_channel(self, channel: str):
-        """Subscribe to a Redis channel"""
-        pubsub = self.redis.pubsub()
-        pubsub.subscribe(channel)
-        return pubsub
-    
-    def get_online_users(self) -> set:
-        """Get set of online user IDs"""
-        return self.redis.smembers("online_users")
-    
-    def add_online_user(self, user_id: int):
-        """Add user to online users set"""
-        self.redis.sadd("online_users", user_id)
-    
-    def remove_online_user(self, user_id: int):
-        """Remove user from online users set"""
-        self.redis.srem("online_users", user_id)
+        self.redis.publish(channel, codec.dumps(message))
     
-    def is_user_online(self, user_id: int) -> bool:
-        """Check if user is online"""
-        return self.redis.sismember("online_users", user_id)
-    
-    def get_chat_channel(self, user1_id: int, user2_id: int) -> str:
-        """Get channel name for 1:1 chat between two users"""
-        # Sort IDs to ensure consistent channel naming
-        sorted_ids = sorted([user1_id, user2_id])
-        return f"chat:{sorted_ids[0]}:{sorted_ids[1]}"
+    def get_worker_channel(self, worker_id: str) -> str:
+        """Get the channel a worker process receives WebSocket deliveries on"""
+        return f"worker:{worker_id}"
+
+
+class AsyncRedisManager:
+    """asyncio-native counterpart of RedisManager for use from async code"""
+    def __init__(self):
+        self.redis = async_redis_client
     
-    def get_typing_channel(self, user1_id: int, user2_id: int) -> str:
-        """Get channel name for typing indicators"""
-        sorted_ids = sorted([user1_id, user2_id])
-        return f"typing:{sorted_ids[0]}:{sorted_ids[1]}"
+    async def publish_message(self, channel: str, message: Dict[str, Any]):
+        """Publish a message to a Redis channel"""
+        await self.redis.publish(channel, codec.dumps(message))
+    
+    async def publish_many(self, messages: Iterable[Tuple[str, str]]):
+        """Publish pre-serialized (channel, payload) pairs in one round trip"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, payload in messages:
+                pipe.publish(channel, payload)
+            await pipe.execute()
+    
+    async def close(self):
+        """Release every pooled connection"""
+        await async_redis_pool.disconnect()
 
 
 redis_manager = RedisManager()
+async_redis_manager = AsyncRedisManager()
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis_client import async_redis_client
+
+
+class RedisSubscriber:
+    """One shared PubSub connection per worker process.
+
+    Channels are subscribed only while a local handler needs them, and every
+    incoming payload is routed through an in-memory dispatch table instead of
+    one PubSub connection per socket.
+    """
+
+    def __init__(self):
+        self.pubsub = None
+        # Dispatch table: channel -> handler called with the raw payload
+        self.handlers: Dict[str, Callable[[str], None]] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self._has_channels = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # Counters
+        self.dispatched = 0
+        self.unrouted = 0
+        self.dispatch_seconds_total = 0.0
+        self.dispatch_seconds_max = 0.0
+
+    async def start(self):
+        """Open the shared PubSub connection and start the listener task"""
+        if self._listener is None:
+            self.pubsub = async_redis_client.pubsub(ignore_subscribe_messages=True)
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """Stop listening and close the shared connection"""
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        self.handlers.clear()
+        self._has_channels.clear()
+
+    async def subscribe(self, channel: str, handler: Callable[[str], None]):
+        """Route payloads on a channel to handler, subscribing if needed"""
+        await self.start()
+        async with self._lock:
+            is_new = channel not in self.handlers
+            self.handlers[channel] = handler
+            if is_new:
+                await self.pubsub.subscribe(channel)
+                self._has_channels.set()
+
+    async def unsubscribe(self, channel: str):
+        """Stop routing a channel and drop the Redis subscription"""
+        async with self._lock:
+            if self.handlers.pop(channel, None) is not None and self.pubsub is not None:
+                await self.pubsub.unsubscribe(channel)
+
+    async def _listen(self):
+        # The PubSub connection only exists after the first SUBSCRIBE
+        await self._has_channels.wait()
+        while True:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=None
+                )
+            except RedisConnectionError as e:
+                # redis-py reconnects and resubscribes on the next read
+                print(f"Redis subscriber connection error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message and message["type"] == "message":
+                self._dispatch(message["channel"], message["data"])
+
+    def _dispatch(self, channel: str, data: str):
+        handler = self.handlers.get(channel)
+        if handler is None:
+            self.unrouted += 1
+            return
+        started = time.perf_counter()
+        try:
+            handler(data)
+        except Exception as e:
+            print(f"Error dispatching message on {channel}: {e}")
+        elapsed = time.perf_counter() - started
+        self.dispatched += 1
+        self.dispatch_seconds_total += elapsed
+        self.dispatch_seconds_max = max(self.dispatch_seconds_max, elapsed)
+
+    def stats(self) -> dict:
+        """Counters for the shared subscriber"""
+        return {
+            "subscribed_channels": len(self.handlers),
+            "dispatched": self.dispatched,
+            "unrouted": self.unrouted,
+            "dispatch_latency_avg_ms": (
+                self.dispatch_seconds_total / self.dispatched * 1000 if self.dispatched else 0.0
+            ),
+            "dispatch_latency_max_ms": self.dispatch_seconds_max * 1000,
+        }
+
+
+subscriber = RedisSubscriber()
@@ -0,0 +1,157 @@
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Set
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import codec
+from cluster import connection_worker, pack_delivery
+from config import settings
+from models import RoomMember
+from presence import presence
+from redis_client import async_redis_client
+
+# room:{id}:members and user:{id}:rooms are Redis set copies of room_members.
+# They are filled from the database on first use and then kept in step by
+# the membership endpoints. Changes only touch a set that is already
+# cached, so a partial set can never be mistaken for a complete one.
+#
+# Each set has a version key that every change bumps. A fill only lands if
+# the version is still the one read before querying, so a reader that
+# loaded the rows before a member was removed can't add them back. The sets
+# also expire, which bounds how long any other drift can last.
+
+ADD_IF_CACHED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[1], ARGV[1])
+end
+"""
+
+# KEYS[1] = set, KEYS[2] = version
+# ARGV[1] = version read before querying, ARGV[2] = TTL in seconds, ARGV[3..] = ids
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def members_key(room_id: int) -> str:
+    return f"room:{room_id}:members"
+
+
+def user_rooms_key(user_id: int) -> str:
+    return f"user:{user_id}:rooms"
+
+
+def room_channel(room_id: int) -> str:
+    """Channel a room's messages are published on, once per message"""
+    return f"room:{room_id}"
+
+
+def control_channel(worker_id: str) -> str:
+    """Channel a worker receives room membership changes on"""
+    return f"worker:{worker_id}:control"
+
+
+def version_key(set_key: str) -> str:
+    return f"{set_key}:version"
+
+
+_add_if_cached = async_redis_client.register_script(ADD_IF_CACHED_SCRIPT)
+_fill = async_redis_client.register_script(FILL_SCRIPT)
+
+
+async def _cached_ids(db: AsyncSession, key: str, query) -> Set[int]:
+    """A cached id set, or the query's ids stored unless the set changed meanwhile"""
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        pipe.smembers(key)
+        pipe.get(version_key(key))
+        cached, version = await pipe.execute()
+    if cached:
+        return {int(value) for value in cached}
+    result = await db.execute(query)
+    ids = set(result.scalars().all())
+    if ids:
+        await _fill(
+            keys=[key, version_key(key)],
+            args=[version or "0", settings.room_membership_cache_ttl_seconds, *ids],
+        )
+    return ids
+
+
+async def get_member_ids(db: AsyncSession, room_id: int) -> Set[int]:
+    """Ids of a room's members, from Redis or loaded into it"""
+    return await _cached_ids(
+        db, members_key(room_id),
+        select(RoomMember.user_id).where(RoomMember.room_id == room_id),
+    )
+
+
+async def is_member(db: AsyncSession, room_id: int, user_id: int) -> bool:
+    """Membership check in O(1) once the room's set is cached"""
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        pipe.sismember(members_key(room_id), user_id)
+        pipe.exists(members_key(room_id))
+        cached_member, cached = await pipe.execute()
+    if cached:
+        return bool(cached_member)
+    return user_id in await get_member_ids(db, room_id)
+
+
+async def get_room_ids(db: AsyncSession, user_id: int) -> Set[int]:
+    """Ids of the rooms a user belongs to, from Redis or loaded into it"""
+    return await _cached_ids(
+        db, user_rooms_key(user_id),
+        select(RoomMember.room_id).where(RoomMember.user_id == user_id),
+    )
+
+
+async def cache_membership(room_id: int, user_ids: Iterable[int], joined: bool):
+    """Apply a committed membership change to the cached sets and to live sockets"""
+    user_ids = list(user_ids)
+    ttl = settings.room_membership_cache_ttl_seconds
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for key in [members_key(room_id), *(user_rooms_key(user_id) for user_id in user_ids)]:
+            # Fences off fills that queried before this change
+            pipe.incr(version_key(key))
+            pipe.expire(version_key(key), ttl)
+        for user_id in user_ids:
+            if joined:
+                await _add_if_cached(keys=[members_key(room_id)], args=[user_id], client=pipe)
+                await _add_if_cached(keys=[user_rooms_key(user_id)], args=[room_id], client=pipe)
+            else:
+                pipe.srem(members_key(room_id), user_id)
+                pipe.srem(user_rooms_key(user_id), room_id)
+        await pipe.execute()
+    await announce_membership(room_id, user_ids, joined)
+
+
+async def announce_membership(room_id: int, user_ids: Iterable[int], joined: bool):
+    """Tell the workers holding these users' sockets to route the room to them"""
+    by_worker: Dict[str, Set[int]] = defaultdict(set)
+    for user_id, connection_ids in (await presence.connections(user_ids)).items():
+        for connection_id in connection_ids:
+            worker_id = connection_worker(connection_id)
+            if worker_id is not None:
+                by_worker[worker_id].add(user_id)
+    if not by_worker:
+        return
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for worker_id, members in by_worker.items():
+            pipe.publish(control_channel(worker_id), codec.dumps({
+                "room_id": room_id, "user_ids": sorted(members), "joined": joined,
+            }))
+        await pipe.execute()
+
+
+async def publish_to_room(room_id: int, event: Dict[str, Any]):
+    """Publish a room event once; each worker fans it out to its local members"""
+    # No recipient list: every local member of the room receives it
+    await async_redis_client.publish(
+        room_channel(room_id), pack_delivery((), codec.dumps(event), event["type"])
+    )
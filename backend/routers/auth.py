@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
 from models import User
 from schemas import UserCreate, UserLogin, User as UserSchema, Token
-from auth import get_password_hash, authenticate_user, create_access_token, get_current_user
+from auth import authenticate_user, create_access_token, get_current_user
+from password_hashing import password_hasher
 from datetime import timedelta
 from config import settings
 
@@ -11,11 +13,12 @@ router = APIRouter(prefix="/auth", tags=["authentication"])
 
 
 @router.post("/register", response_model=UserSchema)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if user already exists
-    db_user = db.query(User).filter(
+    result = await db.execute(select(User).where(
         (User.username == user.username) | (User.email == user.email)
-    ).first()
+    ))
+    db_user = result.scalars().first()
     if db_user:
         raise HTTPException(
             status_code=400,
@@ -23,22 +26,22 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await password_hasher.hash(user.password)
     db_user = User(
         username=user.username,
         email=user.email,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
 
 @router.post("/login", response_model=Token)
-def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, user_credentials.username, user_credentials.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -55,5 +58,5 @@ def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
 
 
 @router.get("/me", response_model=UserSchema)
-def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
@@ -0,0 +1,57 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from database import get_db
+from models import User, Conversation
+from schemas import ConversationSummary, ConversationPage
+from pagination import encode_cursor, decode_cursor
+from auth import get_current_user
+from cache import get_user_profiles
+from unread_counters import unread_counters
+
+router = APIRouter(prefix="/conversations", tags=["conversations"])
+
+
+@router.get("/", response_model=ConversationPage)
+async def list_conversations(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    before: Optional[str] = Query(None, description="Cursor: return conversations older than this"),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Inbox: the user's conversations by last activity, with last message and unread count"""
+    query = select(Conversation).where(Conversation.user_id == current_user.id)
+    if before:
+        query = query.where(
+            tuple_(Conversation.last_message_at, Conversation.last_message_id)
+            < tuple_(*decode_cursor(before))
+        )
+    # Served by ix_conversations_user_last_message; one extra row tells us
+    # whether another page exists
+    result = await db.execute(query.order_by(
+        Conversation.last_message_at.desc(), Conversation.last_message_id.desc()
+    ).limit(limit + 1))
+    rows = list(result.scalars().all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    profiles = await get_user_profiles(db, [row.partner_id for row in rows])
+    unread = await unread_counters.by_conversation(db, current_user.id)
+    conversations = [
+        ConversationSummary(
+            partner_id=row.partner_id,
+            partner_username=profiles.get(row.partner_id, {}).get("username"),
+            last_message_id=row.last_message_id,
+            last_sender_id=row.last_sender_id,
+            last_message_preview=row.last_message_preview,
+            last_message_at=row.last_message_at,
+            unread_count=unread.get(row.partner_id, 0),
+        )
+        for row in rows
+    ]
+    
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(rows[-1].last_message_at, rows[-1].last_message_id)
+    return ConversationPage(conversations=conversations, next_cursor=next_cursor)
@@ -1,51 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from typing import List, Optional
 from database import get_db
 from models import User, Message
-from schemas import MessageCreate, MessageWithUsers, User as UserSchema
-from auth import get_current_user
-from redis_client import redis_manager
-import json
+from schemas import (
+    MessageCreate, MessageWithUsers, MessagePage, ReadReceipt, ReadReceiptCreate,
+    UnreadCounts,
+    User as UserSchema,
+)
+from pagination import encode_cursor, decode_cursor, encode_rank_cursor, decode_rank_cursor
+from auth import get_current_user, load_principal
+from cache import get_user_profiles
+from read_receipts import mark_conversation_read
+from unread_counters import unread_counters
+from search import search_message_ids
+from messaging import send_chat_message
+from recent_messages import recent_messages
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
+# Relationships can't lazy-load under asyncio, so load both ends up front
+with_users = (selectinload(Message.sender), selectinload(Message.receiver))
+
 
 @router.post("/", response_model=MessageWithUsers)
-def send_message(
+async def send_message(
     message: MessageCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if receiver exists
-    receiver = db.query(User).filter(User.id == message.receiver_id).first()
+    receiver = await db.get(User, message.receiver_id)
     if not receiver:
         raise HTTPException(status_code=404, detail="Receiver not found")
     
-    # Create message in database
-    db_message = Message(
-        content=message.content,
-        sender_id=current_user.id,
-        receiver_id=message.receiver_id
+    db_message, _ = await send_chat_message(
+        db, current_user.id, current_user.username, receiver.id, receiver.username, message.content
     )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    
-    # Publish message to Redis channel
-    channel = redis_manager.get_chat_channel(current_user.id, message.receiver_id)
-    message_data = {
-        "type": "message",
-        "id": db_message.id,
-        "content": db_message.content,
-        "sender_id": db_message.sender_id,
-        "receiver_id": db_message.receiver_id,
-        "sender_username": current_user.username,
-        "receiver_username": receiver.username,
-        "is_read": db_message.is_read,
-        "created_at": db_message.created_at.isoformat()
-    }
-    redis_manager.publish_message(channel, message_data)
     
     # Return message with user details
     return MessageWithUsers(
@@ -73,70 +66,197 @@ def send_message(
 
 
 @router.get("/conversation/{user_id}", response_model=List[MessageWithUsers])
-def get_conversation(
+async def get_conversation(
     user_id: int,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100)
 ):
-    # Get messages between current user and specified user
-    messages = db.query(Message).filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.created_at.desc()).offset(skip).limit(limit).all()
-    
-    # Mark messages as read
-    for message in messages:
-        if message.receiver_id == current_user.id and not message.is_read:
-            message.is_read = True
-    db.commit()
+    """Offset-paginated history, kept for existing clients; prefer /history"""
+    cached = await recent_messages.offset_page(db, current_user.id, user_id, skip, limit)
+    messages = await with_user_details(db, cached[0], current_user, user_id) if cached else None
+    response.headers["X-Cache"] = "HIT" if cached and cached[1] and messages is not None else "MISS"
+    if messages is None:
+        # Get messages between current user and specified user
+        result = await db.execute(select(Message).options(*with_users).where(
+            Message.conversation_filter(current_user.id, user_id)
+        ).order_by(Message.created_at.desc(), Message.id.desc()).offset(skip).limit(limit))
+        messages = result.scalars().all()
     
+    await mark_page_read(db, messages, current_user.id, user_id)
     return messages
 
 
+@router.get("/conversation/{user_id}/history", response_model=MessagePage)
+async def get_conversation_history(
+    user_id: int,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this"),
+    limit: int = Query(50, ge=1, le=100)
+):
+    """Cursor-paginated history keyed on (created_at, id), newest first"""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
+    # Page one and cursors inside the recent window skip the messages table
+    cached = await recent_messages.history_page(db, current_user.id, user_id, before, after, limit)
+    messages = await with_user_details(db, cached[0], current_user, user_id) if cached else None
+    response.headers["X-Cache"] = "HIT" if cached and cached[2] and messages is not None else "MISS"
+    if messages is not None:
+        has_more = cached[1]
+    else:
+        position = tuple_(Message.created_at, Message.id)
+        query = select(Message).options(*with_users).where(
+            Message.conversation_filter(current_user.id, user_id)
+        )
+        if after:
+            # Walk forward from the cursor, then flip back to newest first
+            query = query.where(position > tuple_(*decode_cursor(after))).order_by(
+                Message.created_at.asc(), Message.id.asc()
+            )
+        else:
+            if before:
+                query = query.where(position < tuple_(*decode_cursor(before)))
+            query = query.order_by(Message.created_at.desc(), Message.id.desc())
+        
+        # One extra row tells us whether another page exists
+        result = await db.execute(query.limit(limit + 1))
+        messages = list(result.scalars().all())
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after:
+            messages.reverse()
+    
+    await mark_page_read(db, messages, current_user.id, user_id)
+    
+    next_cursor = prev_cursor = None
+    if messages:
+        prev_cursor = encode_cursor(messages[0].created_at, messages[0].id)
+        # Paging forward always leaves the cursor's own message behind us
+        if has_more or after:
+            next_cursor = encode_cursor(messages[-1].created_at, messages[-1].id)
+    elif after:
+        prev_cursor = after
+    
+    return MessagePage(messages=messages, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+async def with_user_details(
+    db: AsyncSession, messages: List[dict], current_user: User, partner_id: int
+) -> Optional[List[MessageWithUsers]]:
+    """Attach both participants to cached messages; None if the partner is unknown"""
+    profile = (await get_user_profiles(db, [partner_id])).get(partner_id)
+    partner = await load_principal(db, profile["username"]) if profile else None
+    if partner is None:
+        return None
+    users = {
+        current_user.id: UserSchema.model_validate(current_user),
+        partner.id: UserSchema.model_validate(partner),
+    }
+    return [
+        MessageWithUsers(**message, sender=users[message["sender_id"]], receiver=users[message["receiver_id"]])
+        for message in messages
+    ]
+
+
+async def mark_page_read(db: AsyncSession, messages: List[Message], reader_id: int, partner_id: int):
+    """Advance the read watermark past the newest unread message on a page"""
+    unread_ids = [
+        message.id for message in messages
+        if message.receiver_id == reader_id and not message.is_read
+    ]
+    if unread_ids:
+        await mark_conversation_read(db, reader_id, partner_id, max(unread_ids))
+
+
 @router.get("/search", response_model=List[MessageWithUsers])
-def search_messages(
+async def search_messages(
     q: str = Query(..., min_length=1),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100)
 ):
-    # Search messages containing the query string
-    messages = db.query(Message).filter(
-        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-        Message.content.contains(q)
-    ).order_by(Message.created_at.desc()).offset(skip).limit(limit).all()
+    """Offset-paginated ranked search, kept for existing clients; prefer /search/page"""
+    matches = await search_message_ids(db, current_user.id, q, limit, offset=skip)
+    return await load_messages([message_id for _, message_id in matches], db)
+
+
+@router.get("/search/page", response_model=MessagePage)
+async def search_messages_page(
+    q: str = Query(..., min_length=1),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    cursor: Optional[str] = Query(None, description="Cursor: return results ranked below this"),
+    limit: int = Query(50, ge=1, le=100)
+):
+    """Full-text search, best match first, every term matched as a prefix"""
+    before = decode_rank_cursor(cursor) if cursor else None
+    matches = await search_message_ids(db, current_user.id, q, limit + 1, before=before)
+    has_more = len(matches) > limit
+    matches = matches[:limit]
     
-    return messages
+    messages = await load_messages([message_id for _, message_id in matches], db)
+    next_cursor = encode_rank_cursor(*matches[-1]) if has_more else None
+    return MessagePage(messages=messages, next_cursor=next_cursor)
+
+
+async def load_messages(message_ids: List[int], db: AsyncSession) -> List[Message]:
+    """Messages with their users, in the order of message_ids"""
+    if not message_ids:
+        return []
+    result = await db.execute(select(Message).options(*with_users).where(Message.id.in_(message_ids)))
+    by_id = {message.id: message for message in result.scalars()}
+    return [by_id[message_id] for message_id in message_ids if message_id in by_id]
+
+
+@router.post("/conversation/{user_id}/read", response_model=ReadReceipt)
+async def mark_conversation_read_endpoint(
+    user_id: int,
+    receipt: ReadReceiptCreate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Mark every message from user_id up to receipt.up_to_id as read"""
+    return await mark_conversation_read(db, current_user.id, user_id, receipt.up_to_id)
 
 
 @router.put("/{message_id}/read")
-def mark_message_read(
+async def mark_message_read(
     message_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    message = db.query(Message).filter(
+    result = await db.execute(select(Message.sender_id).where(
         Message.id == message_id,
         Message.receiver_id == current_user.id
-    ).first()
+    ))
+    sender_id = result.scalar_one_or_none()
     
-    if not message:
+    if sender_id is None:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    message.is_read = True
-    db.commit()
+    # Reading a message implies reading everything before it in the chat
+    await mark_conversation_read(db, current_user.id, sender_id, message_id)
     
     return {"message": "Message marked as read"}
 
 
 @router.get("/unread-count")
-def get_unread_count(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    count = db.query(Message).filter(
-        Message.receiver_id == current_user.id,
-        Message.is_read == False
-    ).count()
+async def get_unread_count(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    count = await unread_counters.total(db, current_user.id)
     
     return {"unread_count": count}
+
+
+@router.get("/unread-counts", response_model=UnreadCounts)
+async def get_unread_counts(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Unread counts for every conversation in one call"""
+    conversations = await unread_counters.by_conversation(db, current_user.id)
+    
+    return UnreadCounts(total=sum(conversations.values()), conversations=conversations)
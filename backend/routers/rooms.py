@@ -0,0 +1,180 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from config import settings
+from database import get_db
+from models import User, ChatRoom, RoomMember, RoomMessage
+from schemas import (
+    Room, RoomCreate, RoomDetail, RoomMemberAdd,
+    RoomMessage as RoomMessageSchema, RoomMessageCreate, RoomMessagePage,
+)
+from pagination import encode_cursor, decode_cursor
+from auth import get_current_user
+from rooms import get_member_ids, is_member, cache_membership, publish_to_room
+
+router = APIRouter(prefix="/rooms", tags=["rooms"])
+
+
+async def get_room_for_member(db: AsyncSession, room_id: int, user_id: int) -> ChatRoom:
+    """The room, or 404 if it doesn't exist or the user isn't in it"""
+    room = await db.get(ChatRoom, room_id)
+    if room is None or not await is_member(db, room_id, user_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    return room
+
+
+@router.post("/", response_model=RoomDetail)
+async def create_room(
+    room: RoomCreate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    member_ids = set(room.member_ids) | {current_user.id}
+    if len(member_ids) > settings.room_max_members:
+        raise HTTPException(status_code=400, detail="Too many members")
+    result = await db.execute(select(User.id).where(User.id.in_(member_ids)))
+    member_ids = set(result.scalars().all())
+
+    db_room = ChatRoom(name=room.name, is_group=True, created_by=current_user.id)
+    db.add(db_room)
+    await db.flush()
+    db.add_all(RoomMember(room_id=db_room.id, user_id=user_id) for user_id in member_ids)
+    await db.commit()
+    await db.refresh(db_room)
+    await cache_membership(db_room.id, member_ids, joined=True)
+
+    return RoomDetail(**Room.model_validate(db_room).model_dump(), member_ids=sorted(member_ids))
+
+
+@router.get("/", response_model=List[Room])
+async def get_my_rooms(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    result = await db.execute(
+        select(ChatRoom).join(RoomMember, RoomMember.room_id == ChatRoom.id)
+        .where(RoomMember.user_id == current_user.id)
+        .order_by(ChatRoom.id)
+    )
+    return result.scalars().all()
+
+
+@router.get("/{room_id}", response_model=RoomDetail)
+async def get_room(
+    room_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    room = await get_room_for_member(db, room_id, current_user.id)
+    member_ids = await get_member_ids(db, room_id)
+    return RoomDetail(**Room.model_validate(room).model_dump(), member_ids=sorted(member_ids))
+
+
+@router.post("/{room_id}/members", response_model=RoomDetail)
+async def add_room_member(
+    room_id: int,
+    member: RoomMemberAdd,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    room = await get_room_for_member(db, room_id, current_user.id)
+    member_ids = await get_member_ids(db, room_id)
+    if member.user_id not in member_ids:
+        if len(member_ids) >= settings.room_max_members:
+            raise HTTPException(status_code=400, detail="Too many members")
+        if await db.get(User, member.user_id) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        # Two concurrent adds of the same user both land here; the loser is a no-op
+        insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+        await db.execute(
+            insert(RoomMember).values(room_id=room_id, user_id=member.user_id)
+            .on_conflict_do_nothing(index_elements=[RoomMember.room_id, RoomMember.user_id])
+        )
+        await db.commit()
+        await cache_membership(room_id, [member.user_id], joined=True)
+        member_ids.add(member.user_id)
+
+    return RoomDetail(**Room.model_validate(room).model_dump(), member_ids=sorted(member_ids))
+
+
+@router.delete("/{room_id}/members/{user_id}")
+async def remove_room_member(
+    room_id: int,
+    user_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    room = await get_room_for_member(db, room_id, current_user.id)
+    # Members may leave; only the creator removes others
+    if user_id != current_user.id and room.created_by != current_user.id:
+        raise HTTPException(status_code=403, detail="Only the room creator can remove members")
+
+    result = await db.execute(delete(RoomMember).where(
+        RoomMember.room_id == room_id, RoomMember.user_id == user_id
+    ))
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Member not found")
+    await db.commit()
+    await cache_membership(room_id, [user_id], joined=False)
+
+    return {"message": "Member removed"}
+
+
+@router.post("/{room_id}/messages", response_model=RoomMessageSchema)
+async def send_room_message(
+    room_id: int,
+    message: RoomMessageCreate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    await get_room_for_member(db, room_id, current_user.id)
+
+    db_message = RoomMessage(room_id=room_id, sender_id=current_user.id, content=message.content)
+    db.add(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+
+    # Published once for the whole room, however many members it has
+    await publish_to_room(room_id, {
+        "type": "room_message",
+        "id": db_message.id,
+        "room_id": room_id,
+        "content": db_message.content,
+        "sender_id": current_user.id,
+        "sender_username": current_user.username,
+        "created_at": db_message.created_at.isoformat()
+    })
+
+    return db_message
+
+
+@router.get("/{room_id}/messages", response_model=RoomMessagePage)
+async def get_room_messages(
+    room_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this"),
+    limit: int = Query(50, ge=1, le=100)
+):
+    """Room history keyed on (created_at, id), newest first"""
+    await get_room_for_member(db, room_id, current_user.id)
+
+    query = select(RoomMessage).where(RoomMessage.room_id == room_id)
+    if before:
+        query = query.where(
+            tuple_(RoomMessage.created_at, RoomMessage.id) < tuple_(*decode_cursor(before))
+        )
+    result = await db.execute(
+        query.order_by(RoomMessage.created_at.desc(), RoomMessage.id.desc()).limit(limit + 1)
+    )
+    messages = list(result.scalars().all())
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(messages[-1].created_at, messages[-1].id)
+    return RoomMessagePage(messages=messages, next_cursor=next_cursor)
@@ -1,51 +1,48 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from database import get_db
 from models import User
 from schemas import User as UserSchema, OnlineUser, UserUpdate
-from auth import get_current_user
-from redis_client import redis_manager
+from auth import get_current_user, invalidate_principal
+from presence import presence
+from cache import get_user_profiles
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 
 @router.get("/online", response_model=List[OnlineUser])
-def get_online_users(
+async def get_online_users(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    online_user_ids = redis_manager.get_online_users()
-    online_users = []
+    online_user_ids = await presence.online_user_ids()
+    online_user_ids.discard(current_user.id)  # Don't include self
+    profiles = await get_user_profiles(db, online_user_ids)
     
-    for user_id in online_user_ids:
-        user = db.query(User).filter(User.id == int(user_id)).first()
-        if user and user.id != current_user.id:  # Don't include self
-            online_users.append(OnlineUser(
-                id=user.id,
-                username=user.username,
-                is_online=True
-            ))
-    
-    return online_users
+    return [
+        OnlineUser(id=profile["id"], username=profile["username"], is_online=True)
+        for profile in profiles.values()
+    ]
 
 
 @router.get("/", response_model=List[UserSchema])
-def get_all_users(
+async def get_all_users(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    users = db.query(User).filter(User.id != current_user.id).all()
-    return users
+    result = await db.execute(select(User).where(User.id != current_user.id))
+    return result.scalars().all()
 
 
 @router.get("/{user_id}", response_model=UserSchema)
-def get_user(
+async def get_user(
     user_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -53,27 +50,30 @@ def get_user(
 
 
 @router.put("/me", response_model=UserSchema)
-def update_current_user(
+async def update_current_user(
     user_update: UserUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if username is already taken by another user
     if user_update.username and user_update.username != current_user.username:
-        existing_user = db.query(User).filter(
+        result = await db.execute(select(User).where(
             User.username == user_update.username,
             User.id != current_user.id
-        ).first()
+        ))
+        existing_user = result.scalars().first()
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already taken")
     
-    # Update user fields
+    # current_user is a cached copy; update the row through this session
+    user = await db.get(User, current_user.id)
     if user_update.username:
-        current_user.username = user_update.username
+        user.username = user_update.username
     if user_update.email:
-        current_user.email = user_update.email
+        user.email = user_update.email
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    await db.refresh(user)
+    await invalidate_principal(user.id, current_user.username)
     
-    return current_user
+    return user
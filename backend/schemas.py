@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 
@@ -55,6 +55,90 @@ class MessageWithUsers(Message):
     receiver: User
 
 
+class MessagePage(BaseModel):
+    messages: List[MessageWithUsers]
+    # Pass as `before` to load older messages; None when there are none
+    next_cursor: Optional[str] = None
+    # Pass as `after` to load newer messages
+    prev_cursor: Optional[str] = None
+
+
+class ConversationSummary(BaseModel):
+    partner_id: int
+    partner_username: Optional[str] = None
+    last_message_id: int
+    last_sender_id: int
+    last_message_preview: str
+    last_message_at: datetime
+    unread_count: int = 0
+
+
+class ConversationPage(BaseModel):
+    conversations: List[ConversationSummary]
+    # Pass as `before` to load older conversations; None when there are none
+    next_cursor: Optional[str] = None
+
+
+class ReadReceiptCreate(BaseModel):
+    # Newest message to mark read; defaults to the whole conversation
+    up_to_id: Optional[int] = None
+
+
+class ReadReceipt(BaseModel):
+    marked_read: int
+    last_read_message_id: int
+
+
+class UnreadCounts(BaseModel):
+    total: int
+    # Unread messages keyed by the partner who sent them
+    conversations: Dict[int, int]
+
+
+class RoomCreate(BaseModel):
+    name: str
+    member_ids: List[int] = []
+
+
+class Room(BaseModel):
+    id: int
+    name: str
+    is_group: bool
+    created_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+
+class RoomDetail(Room):
+    member_ids: List[int]
+
+
+class RoomMemberAdd(BaseModel):
+    user_id: int
+
+
+class RoomMessageCreate(BaseModel):
+    content: str
+
+
+class RoomMessage(RoomMessageCreate):
+    id: int
+    room_id: int
+    sender_id: int
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
+class RoomMessagePage(BaseModel):
+    messages: List[RoomMessage]
+    # Pass as `before` to load older messages; None when there are none
+    next_cursor: Optional[str] = None
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -0,0 +1,83 @@
+import asyncio
+from typing import List, Optional, Tuple
+from sqlalchemy import select, func, literal_column, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Message
+from search_index import search_index, tokenize
+
+# Longer queries are truncated rather than building huge tsqueries
+MAX_QUERY_TERMS = 8
+
+_index_lock = asyncio.Lock()
+
+
+def query_terms(q: str) -> List[str]:
+    """Distinct search terms in q, each later matched as a prefix"""
+    return list(dict.fromkeys(tokenize(q)))[:MAX_QUERY_TERMS]
+
+
+async def search_message_ids(
+    db: AsyncSession,
+    user_id: int,
+    q: str,
+    limit: int,
+    before: Optional[Tuple[float, int]] = None,
+    offset: int = 0,
+) -> List[Tuple[float, int]]:
+    """(rank, message_id) of user_id's messages matching q, ordered by (rank, id) desc.
+
+    `before` is a (rank, id) keyset position; results start right after it.
+    """
+    terms = query_terms(q)
+    if not terms:
+        return []
+    if db.bind.dialect.name == "postgresql":
+        return await _search_postgres(db, user_id, terms, limit, before, offset)
+    return await _search_fallback(db, user_id, terms, limit, before, offset)
+
+
+async def _search_postgres(db, user_id, terms, limit, before, offset):
+    # Terms are \w+ tokens, so they never contain tsquery operators
+    query = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{term}:*" for term in terms))
+    document = Message.search_document()  # served by ix_messages_content_fts
+    rank = func.ts_rank(document, query)
+
+    statement = select(rank, Message.id).where(
+        document.op("@@")(query),
+        (Message.sender_id == user_id) | (Message.receiver_id == user_id),
+    )
+    if before is not None:
+        statement = statement.where(tuple_(rank, Message.id) < tuple_(*before))
+    result = await db.execute(
+        statement.order_by(rank.desc(), Message.id.desc()).offset(offset).limit(limit)
+    )
+    return [(score, message_id) for score, message_id in result]
+
+
+async def _search_fallback(db, user_id, terms, limit, before, offset):
+    await _load_index(db)
+    matches = search_index.search(terms, user_id)
+    if before is not None:
+        matches = [match for match in matches if match < before]
+    return matches[offset:offset + limit]
+
+
+async def _load_index(db: AsyncSession):
+    """Build the in-process index from the messages table on first use"""
+    if search_index.loaded:
+        return
+    async with _index_lock:
+        if search_index.loaded:
+            return
+        result = await db.stream(
+            select(Message.id, Message.sender_id, Message.receiver_id, Message.content)
+        )
+        async for message_id, sender_id, receiver_id, content in result:
+            search_index.add(message_id, sender_id, receiver_id, content)
+        search_index.loaded = True
+
+
+def index_message(message: Message):
+    """Keep the fallback index current after an insert (Postgres indexes itself)"""
+    if search_index.loaded:
+        search_index.add(message.id, message.sender_id, message.receiver_id, message.content)
@@ -0,0 +1,90 @@
+import math
+import re
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, roughly what Postgres' 'simple' config produces"""
+    return TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """In-process inverted index over message content.
+
+    Used when the database has no full-text search (SQLite test runs). Every
+    query term is matched as a prefix, like `term:*` in a Postgres tsquery, and
+    results are ranked by a simple tf-idf score.
+    """
+
+    def __init__(self):
+        # term -> {message_id: occurrences}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        # message_id -> (sender_id, receiver_id), to scope results to a user
+        self.participants: Dict[int, Tuple[int, int]] = {}
+        self.lengths: Dict[int, int] = {}
+        # Sorted vocabulary for prefix lookups, rebuilt lazily after inserts
+        self._terms: List[str] = []
+        self._terms_stale = False
+        self.loaded = False
+
+    def add(self, message_id: int, sender_id: int, receiver_id: int, content: str):
+        if message_id in self.participants:
+            return
+        tokens = tokenize(content)
+        self.participants[message_id] = (sender_id, receiver_id)
+        self.lengths[message_id] = len(tokens) or 1
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                self._terms_stale = True
+            postings[message_id] = postings.get(message_id, 0) + 1
+
+    def expand(self, prefix: str) -> List[str]:
+        """Indexed terms starting with prefix"""
+        if self._terms_stale:
+            self._terms = sorted(self.postings)
+            self._terms_stale = False
+        terms = []
+        for term in self._terms[bisect_left(self._terms, prefix):]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, terms: List[str], user_id: int) -> List[Tuple[float, int]]:
+        """(rank, message_id) for user_id's messages matching every term, best first"""
+        total = len(self.participants) or 1
+        scores: Optional[Dict[int, float]] = None
+        for prefix in terms:
+            term_scores: Dict[int, float] = {}
+            for term in self.expand(prefix):
+                postings = self.postings[term]
+                idf = math.log(1 + total / len(postings))
+                for message_id, count in postings.items():
+                    score = count / self.lengths[message_id] * idf
+                    term_scores[message_id] = term_scores.get(message_id, 0.0) + score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {
+                    message_id: score + term_scores[message_id]
+                    for message_id, score in scores.items()
+                    if message_id in term_scores
+                }
+            if not scores:
+                return []
+
+        return sorted(
+            (
+                (score, message_id) for message_id, score in scores.items()
+                if user_id in self.participants[message_id]
+            ),
+            reverse=True,
+        )
+
+
+search_index = InvertedIndex()
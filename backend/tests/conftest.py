@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+import tempfile
+import pytest
+
+# Tests import the backend's flat modules directly, as main.py does
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Settings are read at import time, so point them at a scratch database first
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+if fakeredis is not None:
+    import redis_client
+
+    # Modules bind the clients when imported, so swap in one in-memory
+    # server before any of them are; every "worker" in a test shares it
+    server = fakeredis.FakeServer()
+    redis_client.redis_client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    redis_client.async_redis_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    redis_client.redis_manager.redis = redis_client.redis_client
+    redis_client.async_redis_manager.redis = redis_client.async_redis_client
+
+
+@pytest.fixture(scope="session")
+def schema():
+    """The scratch database, built by the Alembic migrations like production"""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(os.path.join(BACKEND_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(BACKEND_DIR, "alembic"))
+    command.upgrade(config, "head")
+
+
+@pytest.fixture(scope="module")
+def users(schema):
+    """Two users, alice (1) and bob (2); every table is emptied afterwards"""
+    from database import Base, SessionLocal
+    from models import User
+
+    with SessionLocal() as db:
+        db.add_all([
+            User(id=1, username="alice", email="alice@example.com", hashed_password="x"),
+            User(id=2, username="bob", email="bob@example.com", hashed_password="x"),
+        ])
+        db.commit()
+    yield
+    with SessionLocal() as db:
+        for table in reversed(Base.metadata.sorted_tables):
+            db.execute(table.delete())
+        db.commit()
+
+
+@pytest.fixture(scope="session")
+def run():
+    """Run a coroutine on one loop shared by every test, as the pooled async
+    engine and Redis clients are bound to the loop they were first used on
+    """
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy import event
+from cache import PROFILE_BATCH_SIZE, get_user_profiles, user_profile_cache
+from database import AsyncSessionLocal, async_engine
+
+pytestmark = pytest.mark.usefixtures("users")
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    user_profile_cache.clear()
+
+
+@pytest.fixture
+def bind_counts():
+    """Bind parameters per statement sent to the database"""
+    counts = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        counts.append(len(parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    yield counts
+    event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+async def profiles(user_ids):
+    async with AsyncSessionLocal() as db:
+        return await get_user_profiles(db, user_ids)
+
+
+def test_large_lookups_are_split_into_batches(run, bind_counts):
+    user_ids = [*range(1000, 1000 + 2 * PROFILE_BATCH_SIZE), 2, 1]
+    assert run(profiles(user_ids)) == {
+        1: {"id": 1, "username": "alice"},
+        2: {"id": 2, "username": "bob"},
+    }
+    assert bind_counts == [PROFILE_BATCH_SIZE, PROFILE_BATCH_SIZE, 2]
+
+
+def test_cached_profiles_skip_the_query(run, bind_counts):
+    run(profiles([1]))
+    assert run(profiles([1, 2])) == {
+        1: {"id": 1, "username": "alice"},
+        2: {"id": 2, "username": "bob"},
+    }
+    assert bind_counts == [1, 1]
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import main
+import websocket_manager
+from auth import create_access_token
+from presence import presence
+from websocket_manager import ConnectionManager
+
+pytestmark = pytest.mark.usefixtures("users")
+
+
+class FakeWebSocket:
+    scope = {}
+
+    def __init__(self):
+        self.closed = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        self.closed = code
+
+
+async def fail(*args, **kwargs):
+    raise ConnectionError("redis went away")
+
+
+def test_failed_connect_unregisters_the_connection(run, monkeypatch):
+    monkeypatch.setattr(websocket_manager, "events_since", fail)
+    manager = ConnectionManager("worker-connect")
+
+    with pytest.raises(ConnectionError):
+        run(manager.connect(FakeWebSocket(), 1, "alice", last_event_id=5))
+
+    assert manager.active_connections == {}
+    assert run(presence.connections([1])) == {}
+
+
+def test_endpoint_unregisters_when_setup_after_connect_fails(run, monkeypatch):
+    monkeypatch.setattr(main.manager, "broadcast_online_users", fail)
+    websocket = FakeWebSocket()
+
+    run(main.websocket_endpoint(websocket, create_access_token({"sub": "bob"})))
+
+    assert websocket.closed == 1008
+    assert main.manager.active_connections == {}
+    assert run(presence.connections([2])) == {}
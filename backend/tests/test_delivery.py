@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from cluster import connection_worker
+from delivery import deliver_to_users
+from redis_subscriber import RedisSubscriber
+from websocket_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+
+pytestmark = pytest.mark.usefixtures("users")
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+def queued_types(connection):
+    return [event_type for _, event_type in connection.outbound]
+
+
+def test_delivery_reaches_users_on_two_workers(run):
+    async def scenario():
+        subscribers = [RedisSubscriber(), RedisSubscriber()]
+        worker_a = ConnectionManager("worker-a", subscribers[0])
+        worker_b = ConnectionManager("worker-b", subscribers[1])
+        try:
+            await worker_a.start()
+            await worker_b.start()
+            alice = await worker_a.connect(FakeWebSocket(), 1, "alice")
+            bob = await worker_b.connect(FakeWebSocket(), 2, "bob")
+            assert connection_worker(alice.id) == "worker-a"
+            assert connection_worker(bob.id) == "worker-b"
+
+            published = await deliver_to_users(
+                [1, 2], {"type": "message", "content": "hi"}, replayable=True
+            )
+            assert published == 2
+            assert await wait_for(lambda: "message" in queued_types(alice))
+            assert await wait_for(lambda: "message" in queued_types(bob))
+            # Each worker only holds its own user's socket
+            assert set(worker_a.active_connections) == {1}
+            assert set(worker_b.active_connections) == {2}
+
+            # An event for one user is published only to that user's worker
+            assert await deliver_to_users([2], {"type": "message", "content": "bob only"}) == 1
+            assert await wait_for(lambda: queued_types(bob).count("message") == 2)
+            await asyncio.sleep(0.05)
+            assert queued_types(alice).count("message") == 1
+
+            await worker_a.disconnect(alice)
+            await worker_b.disconnect(bob)
+        finally:
+            for manager in (worker_a, worker_b):
+                await manager.stop()
+            for subscriber in subscribers:
+                await subscriber.stop()
+
+    run(scenario())
@@ -0,0 +1,103 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import codec
+from event_streams import append_event, events_since, stream_key
+from redis_client import async_redis_client
+from websocket_manager import Connection, ConnectionManager
+
+CAROL, DAVE = 301, 302
+
+
+@pytest.fixture(autouse=True)
+def clean(run):
+    run(async_redis_client.delete(stream_key(CAROL), stream_key(DAVE)))
+
+
+def append(run, *user_ids, type="message"):
+    payload = run(append_event(user_ids, codec.dumps({"type": type})))
+    return codec.loads(payload)["event_id"]
+
+
+def connection(user_id=CAROL):
+    return Connection(None, user_id, "carol", {"dropped": 0, "evicted": 0}, worker_id="worker-replay")
+
+
+def test_replay_returns_missed_events_in_order(run):
+    seen = append(run, CAROL)
+    # Another user's events take ids from the same counter
+    append(run, DAVE)
+    missed = [append(run, CAROL, DAVE), append(run, CAROL)]
+
+    events = run(events_since(CAROL, seen, limit=10))
+    assert [event_id for event_id, _ in events] == missed
+    assert codec.loads(events[0][1])["event_id"] == missed[0]
+
+
+def test_caught_up_client_gets_nothing_to_replay(run):
+    latest = append(run, CAROL)
+    assert run(events_since(CAROL, latest, limit=10)) == []
+
+
+def test_trimmed_events_force_a_resync(run):
+    seen = append(run, CAROL)
+    first_missed = append(run, CAROL)
+    append(run, CAROL)
+    run(async_redis_client.xdel(stream_key(CAROL), f"{first_missed}-0"))
+
+    assert run(events_since(CAROL, seen, limit=10)) is None
+
+
+def test_expired_stream_forces_a_resync(run):
+    seen = append(run, CAROL)
+    run(async_redis_client.delete(stream_key(CAROL)))
+
+    assert run(events_since(CAROL, seen, limit=10)) is None
+
+
+def test_more_missed_events_than_the_limit_force_a_resync(run):
+    seen = append(run, CAROL)
+    for _ in range(3):
+        append(run, CAROL)
+
+    assert run(events_since(CAROL, seen, limit=2)) is None
+    assert len(run(events_since(CAROL, seen, limit=3))) == 3
+
+
+def test_replay_goes_ahead_of_live_frames_without_duplicates():
+    conn = connection()
+    # Delivered live while the replay was being read from the stream
+    conn.enqueue(codec.dumps({"type": "message", "event_id": 8}), "message")
+    conn.enqueue(codec.dumps({"type": "user_status"}), "user_status")
+
+    conn.queue_replay([
+        (7, codec.dumps({"type": "message", "event_id": 7})),
+        (8, codec.dumps({"type": "message", "event_id": 8})),
+    ])
+
+    assert [codec.loads(payload).get("event_id") for payload, _ in conn.outbound] == [7, 8, None]
+
+
+def test_gap_on_reconnect_sends_resync(run):
+    seen = append(run, CAROL)
+    run(async_redis_client.delete(stream_key(CAROL)))
+    manager = ConnectionManager("worker-replay")
+    conn = connection()
+
+    run(manager.replay(conn, seen))
+
+    assert [codec.loads(payload) for payload, _ in conn.outbound] == [{"type": "resync"}]
+    assert manager.replay_stats["resyncs"] == 1
+
+
+def test_reconnect_replays_what_was_missed(run):
+    seen = append(run, CAROL)
+    missed = append(run, CAROL)
+    manager = ConnectionManager("worker-replay")
+    conn = connection()
+
+    run(manager.replay(conn, seen))
+
+    assert [codec.loads(payload)["event_id"] for payload, _ in conn.outbound] == [missed]
+    assert manager.replay_stats["replayed_events"] == 1
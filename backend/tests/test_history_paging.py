@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from fastapi import HTTPException, Response
+from database import AsyncSessionLocal, SessionLocal
+from models import Conversation, Message, ReadWatermark, User
+from pagination import encode_cursor
+from recent_messages import recent_messages
+from redis_client import async_redis_client
+from routers.messages import get_conversation_history
+
+pytestmark = pytest.mark.usefixtures("users")
+
+ALICE, BOB = 1, 2
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def clean(run, monkeypatch):
+    # A window smaller than the conversation, so later pages read the table
+    monkeypatch.setattr(recent_messages, "size", 3)
+    with SessionLocal() as db:
+        for model in (Message, ReadWatermark, Conversation):
+            db.query(model).delete()
+        db.commit()
+    run(async_redis_client.delete(*recent_messages._keys(ALICE, BOB)))
+
+
+def seed(count):
+    """count messages, newest last; pairs share a timestamp so ids break ties"""
+    with SessionLocal() as db:
+        messages = [
+            Message(
+                content=f"m{n}", sender_id=(ALICE, BOB)[n % 2], receiver_id=(BOB, ALICE)[n % 2],
+                created_at=START + timedelta(seconds=n // 2),
+            )
+            for n in range(count)
+        ]
+        db.add_all(messages)
+        db.commit()
+        return [message.id for message in messages]
+
+
+def history(run, before=None, after=None, limit=2):
+    async def fetch():
+        async with AsyncSessionLocal() as db:
+            alice = await db.get(User, ALICE)
+            return await get_conversation_history(
+                BOB, Response(), current_user=alice, db=db, before=before, after=after, limit=limit
+            )
+    return run(fetch())
+
+
+def test_walking_back_visits_every_message_once(run):
+    ids = seed(7)
+    seen, cursor = [], None
+    while True:
+        page = history(run, before=cursor)
+        seen += [message.id for message in page.messages]
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert seen == ids[::-1]
+
+
+def test_walking_forward_visits_every_message_once(run):
+    ids = seed(7)
+    oldest = history(run, before=encode_cursor(START, ids[1]))
+    assert [message.id for message in oldest.messages] == [ids[0]]
+
+    # prev_cursor points at newer messages; an empty page means caught up
+    seen, cursor = [], oldest.prev_cursor
+    while True:
+        page = history(run, after=cursor)
+        if not page.messages:
+            break
+        seen += [message.id for message in reversed(page.messages)]
+        cursor = page.prev_cursor
+    assert seen == ids[1:]
+
+
+def test_after_the_newest_message_is_empty_and_keeps_the_cursor(run):
+    seed(3)
+    newest = history(run).prev_cursor
+    page = history(run, after=newest)
+    assert page.messages == []
+    assert page.next_cursor is None
+    assert page.prev_cursor == newest
+
+
+def test_empty_conversation_has_no_cursors(run):
+    page = history(run)
+    assert page.messages == []
+    assert page.next_cursor is None and page.prev_cursor is None
+
+
+def test_exact_last_page_has_no_next_cursor(run):
+    ids = seed(4)
+    page = history(run, before=encode_cursor(START + timedelta(seconds=1), ids[2]))
+    assert [message.id for message in page.messages] == [ids[1], ids[0]]
+    assert page.next_cursor is None
+
+
+@pytest.mark.parametrize("before, after", [("x", None), (None, "bm90IGEgY3Vyc29y"), ("x", "x")])
+def test_bad_cursors_are_400(run, before, after):
+    with pytest.raises(HTTPException) as raised:
+        history(run, before=before, after=after)
+    assert raised.value.status_code == 400
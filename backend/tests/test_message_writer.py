@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from fastapi import HTTPException
+from sqlalchemy.exc import OperationalError
+from database import SessionLocal
+from message_writer import DEAD_LETTER_KEY, JOURNAL_KEY, MessageWriter
+from models import Message
+from redis_client import async_redis_client
+
+pytestmark = pytest.mark.usefixtures("users")
+
+
+@pytest.fixture
+def writer(run):
+    run(async_redis_client.delete(JOURNAL_KEY, DEAD_LETTER_KEY))
+    with SessionLocal() as db:
+        db.query(Message).delete()
+        db.commit()
+    return MessageWriter()
+
+
+def stored_ids():
+    with SessionLocal() as db:
+        return sorted(message_id for (message_id,) in db.query(Message.id))
+
+
+def test_full_buffer_rejects_sends(run, writer):
+    writer.max_buffered = 2
+    run(writer.submit(1, 2, "one"))
+    run(writer.submit(1, 2, "two"))
+
+    with pytest.raises(HTTPException) as rejected:
+        run(writer.submit(1, 2, "three"))
+
+    assert rejected.value.status_code == 503
+    assert len(writer.buffer) == 2 and writer.rejected == 1
+
+
+def test_poison_row_is_dead_lettered(run, writer):
+    before = run(writer.submit(1, 2, "before"))
+    # content is NOT NULL, so the database refuses this row whatever happens
+    poison = run(writer.submit(1, 2, None))
+    after = run(writer.submit(1, 2, "after"))
+
+    assert run(writer.flush())
+
+    assert stored_ids() == [before.id, after.id]
+    assert writer.buffer == [] and writer.dead_lettered == 1 and writer.flushed == 2
+    assert list(run(async_redis_client.hkeys(DEAD_LETTER_KEY))) == [str(poison.id)]
+    assert run(async_redis_client.hlen(JOURNAL_KEY)) == 0
+
+
+def test_database_outage_keeps_rows_buffered(run, writer, monkeypatch):
+    run(writer.submit(1, 2, "one"))
+    run(writer.submit(1, 2, "two"))
+
+    async def unavailable(rows):
+        raise OperationalError("INSERT", {}, ConnectionError("database is down"))
+
+    monkeypatch.setattr(writer, "_insert", unavailable)
+    assert not run(writer.flush())
+
+    assert len(writer.buffer) == 2 and writer.dead_lettered == 0
+    assert run(async_redis_client.hlen(JOURNAL_KEY)) == 2
+    monkeypatch.undo()
+    assert run(writer.flush()) and len(stored_ids()) == 2
@@ -0,0 +1,85 @@
+import time
+import pytest
+
+import codec
+from config import settings
+from websocket_manager import Connection
+
+
+@pytest.fixture(autouse=True)
+def small_queue(monkeypatch):
+    monkeypatch.setattr(settings, "ws_outbound_queue_size", 3)
+    monkeypatch.setattr(settings, "ws_drop_policy", "drop_oldest")
+    monkeypatch.setattr(settings, "ws_slow_consumer_seconds", 10)
+
+
+@pytest.fixture
+def conn():
+    return Connection(None, 1, "alice", {"dropped": 0, "evicted": 0}, worker_id="worker-queue")
+
+
+def frame(n, event_type):
+    return codec.dumps({"type": event_type, "n": n})
+
+
+def queued(conn):
+    return [(codec.loads(payload)["n"], event_type) for payload, event_type in conn.outbound]
+
+
+def test_full_queue_drops_the_oldest_low_value_frame(conn):
+    conn.enqueue(frame(1, "message"), "message")
+    conn.enqueue(frame(2, "typing"), "typing")
+    conn.enqueue(frame(3, "message"), "message")
+
+    assert conn.enqueue(frame(4, "message"), "message")
+
+    assert queued(conn) == [(1, "message"), (3, "message"), (4, "message")]
+    assert conn._stats["dropped"] == 1
+    assert conn._stats["dropped_typing"] == 1
+    assert not conn.evicted.is_set()
+
+
+def test_drop_newest_discards_the_incoming_low_value_frame(conn, monkeypatch):
+    monkeypatch.setattr(settings, "ws_drop_policy", "drop_newest")
+    for n in range(3):
+        conn.enqueue(frame(n, "user_status"), "user_status")
+
+    assert not conn.enqueue(frame(3, "typing"), "typing")
+
+    assert [n for n, _ in queued(conn)] == [0, 1, 2]
+    assert conn._stats["dropped_typing"] == 1
+
+
+def test_low_value_frame_is_dropped_when_nothing_else_can_be(conn):
+    for n in range(3):
+        conn.enqueue(frame(n, "message"), "message")
+
+    assert not conn.enqueue(frame(3, "typing"), "typing")
+
+    assert [n for n, _ in queued(conn)] == [0, 1, 2]
+    assert not conn.evicted.is_set()
+
+
+def test_message_that_cannot_fit_evicts_instead_of_being_lost(conn):
+    for n in range(3):
+        conn.enqueue(frame(n, "message"), "message")
+
+    assert not conn.enqueue(frame(3, "message"), "message")
+
+    assert conn.evicted.is_set()
+    assert not conn.outbound
+    assert conn._stats["evicted"] == 1
+    # Nothing more is queued for an evicted connection
+    assert not conn.enqueue(frame(4, "typing"), "typing")
+
+
+def test_queue_full_for_too_long_evicts(conn):
+    for n in range(3):
+        conn.enqueue(frame(n, "typing"), "typing")
+
+    # Full, but still making room by dropping low-value frames
+    assert conn.enqueue(frame(3, "typing"), "typing")
+    conn._full_since = time.monotonic() - settings.ws_slow_consumer_seconds - 1
+    assert not conn.enqueue(frame(4, "typing"), "typing")
+
+    assert conn.evicted.is_set()
@@ -0,0 +1,45 @@
+import os
+import signal
+import time
+import pytest
+from fastapi import HTTPException
+from password_hashing import PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher()
+    hasher.workers = 1
+    yield hasher
+    hasher.stop()
+
+
+def kill_workers(hasher, run):
+    # Spawn the worker first, then kill it as the OOM killer would
+    run(hasher._run(os.getpid))
+    pool = hasher._pool
+    for process in list(pool._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return pool
+
+
+def test_broken_pool_is_replaced_and_the_call_retried(hasher, run):
+    broken = kill_workers(hasher, run)
+    hashed = run(hasher.hash("secret"))
+    assert run(hasher.verify_and_update("secret", hashed))[0]
+    assert hasher._pool is not broken
+    assert hasher.stats()["restarts"] == 1
+    assert hasher.pending == 0
+
+
+def test_pool_that_keeps_breaking_returns_503(hasher, run):
+    with pytest.raises(HTTPException) as raised:
+        # Every attempt takes its worker down with it
+        run(hasher._run(os._exit, 1))
+    assert raised.value.status_code == 503
+    assert "Retry-After" in raised.value.headers
+    assert hasher.stats()["restarts"] == 2
+    assert hasher.pending == 0
@@ -0,0 +1,118 @@
+"""The message hot queries must be served by the indexes from migration 0002.
+
+Each test runs the real endpoint or query function against the migrated
+scratch database, records the SQL it sends and checks SQLite's EXPLAIN
+QUERY PLAN for the expected index instead of a table scan.
+
+Search isn't covered: SQLite answers it from the in-process index in
+search_index.py, and the Postgres full-text plan can't be checked here.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Tuple
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from fastapi import Response
+from sqlalchemy import event
+import cache
+from database import AsyncSessionLocal, async_engine, engine
+from models import User
+from pagination import encode_cursor
+from recent_messages import recent_messages
+from redis_client import async_redis_client
+from routers.messages import get_conversation, get_conversation_history
+from unread_counters import unread_counters
+
+pytestmark = pytest.mark.usefixtures("users")
+
+ALICE, BOB = 1, 2
+CURSOR = encode_cursor(datetime(2024, 1, 1, tzinfo=timezone.utc), 100)
+
+
+@pytest.fixture(autouse=True)
+def clean(run):
+    # Empty caches, so every call below reaches the database
+    run(async_redis_client.delete(
+        *recent_messages._keys(ALICE, BOB), unread_counters.key(ALICE), unread_counters.generation_key(ALICE),
+    ))
+    cache.contact_cache.clear()
+
+
+@contextmanager
+def recorded_selects():
+    """Collect the SELECTs on the messages table run inside the block"""
+    statements: List[Tuple[str, tuple]] = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM messages" in statement:
+            statements.append((statement, tuple(parameters)))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+def query_plans(run, call) -> List[List[str]]:
+    """Run call(db, alice) and return the plan of each messages query it made"""
+    async def invoke():
+        async with AsyncSessionLocal() as db:
+            await call(db, await db.get(User, ALICE))
+
+    with recorded_selects() as statements:
+        run(invoke())
+    assert statements, "no query reached the messages table"
+    with engine.connect() as connection:
+        return [
+            [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+            for statement, parameters in statements
+        ]
+
+
+def assert_uses_index(plan: List[str], index_name: str):
+    assert any(f"USING INDEX {index_name}" in step or f"USING COVERING INDEX {index_name}" in step
+               for step in plan), plan
+    assert not any(step.startswith("SCAN messages") for step in plan), plan
+
+
+def test_conversation_history_page_one_uses_conversation_index(run):
+    # Filling the recent window on a cold cache
+    plans = query_plans(run, lambda db, alice: get_conversation_history(
+        BOB, Response(), current_user=alice, db=db, before=None, after=None, limit=50
+    ))
+    for plan in plans:
+        assert_uses_index(plan, "ix_messages_conversation_created")
+
+
+@pytest.mark.parametrize("before, after", [(CURSOR, None), (None, CURSOR)])
+def test_conversation_history_cursor_uses_conversation_index(run, before, after):
+    # A cursor outside the (empty) window goes to the keyset query
+    plans = query_plans(run, lambda db, alice: get_conversation_history(
+        BOB, Response(), current_user=alice, db=db, before=before, after=after, limit=50
+    ))
+    for plan in plans:
+        assert_uses_index(plan, "ix_messages_conversation_created")
+
+
+def test_conversation_offset_past_window_uses_conversation_index(run):
+    plans = query_plans(run, lambda db, alice: get_conversation(
+        BOB, Response(), current_user=alice, db=db, skip=500, limit=50
+    ))
+    for plan in plans:
+        assert_uses_index(plan, "ix_messages_conversation_created")
+
+
+def test_unread_rebuild_uses_unread_and_receiver_indexes(run):
+    # Behind /messages/unread-count(s) when the counters are cold
+    [plan] = query_plans(run, lambda db, alice: unread_counters.total(db, alice.id))
+    assert_uses_index(plan, "ix_messages_unread")
+    assert_uses_index(plan, "ix_messages_receiver_created")
+
+
+def test_contact_ids_use_sender_and_receiver_indexes(run):
+    [plan] = query_plans(run, lambda db, alice: cache.get_contact_ids(db, alice.id))
+    assert_uses_index(plan, "ix_messages_sender_created")
+    assert_uses_index(plan, "ix_messages_receiver_created")
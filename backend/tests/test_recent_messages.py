@@ -0,0 +1,93 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from database import AsyncSessionLocal, SessionLocal
+from models import Message, ReadWatermark
+from read_receipts import mark_conversation_read
+from recent_messages import recent_messages
+from redis_client import async_redis_client
+
+pytestmark = pytest.mark.usefixtures("users")
+
+ALICE, BOB = 1, 2
+KEY, GENERATION_KEY = recent_messages._keys(ALICE, BOB)
+
+
+@pytest.fixture(autouse=True)
+def clean(run):
+    with SessionLocal() as db:
+        db.query(Message).delete()
+        db.query(ReadWatermark).delete()
+        db.commit()
+    run(async_redis_client.delete(KEY, GENERATION_KEY))
+
+
+def send(sender_id, receiver_id, count=1):
+    with SessionLocal() as db:
+        messages = [Message(content="hi", sender_id=sender_id, receiver_id=receiver_id) for _ in range(count)]
+        db.add_all(messages)
+        db.commit()
+        for message in messages:
+            db.refresh(message)
+        db.expunge_all()
+        return messages
+
+
+async def window():
+    async with AsyncSessionLocal() as db:
+        messages, _, hit = await recent_messages.window(db, ALICE, BOB)
+    return {message["id"]: message["is_read"] for message in messages}, hit
+
+
+def test_read_receipt_marks_cached_entries_in_place(run):
+    from_bob = send(BOB, ALICE, 3)
+    from_alice = send(ALICE, BOB)
+    run(window())
+
+    async def read_up_to(message_id):
+        async with AsyncSessionLocal() as db:
+            await mark_conversation_read(db, ALICE, BOB, message_id)
+
+    run(read_up_to(from_bob[1].id))
+
+    read, hit = run(window())
+    assert hit
+    assert read == {
+        from_bob[0].id: True, from_bob[1].id: True, from_bob[2].id: False, from_alice[0].id: False,
+    }
+    # The entries still start with "id" for the append script
+    assert all(entry.startswith('{"id":') for entry in run(async_redis_client.lrange(KEY, 0, -1)))
+
+
+def test_mark_read_fences_fills_in_flight(run):
+    [message] = send(BOB, ALICE)
+    generation = run(async_redis_client.get(GENERATION_KEY))
+    stale = recent_messages._serialize(message)
+    run(recent_messages.mark_read(ALICE, BOB, message.id))
+
+    run(recent_messages._fill(keys=[KEY, GENERATION_KEY], args=[generation or "0", 60, stale]))
+    assert run(async_redis_client.exists(KEY)) == 0
+
+
+def test_send_without_a_list_fences_fills_in_flight(run):
+    generation = run(async_redis_client.get(GENERATION_KEY))
+    [message] = send(BOB, ALICE)
+    run(recent_messages.append(message))
+
+    run(recent_messages._fill(keys=[KEY, GENERATION_KEY], args=[generation or "0", 60, "{}"]))
+    assert run(async_redis_client.exists(KEY)) == 0
+
+
+def test_out_of_order_append_drops_the_list(run):
+    [first] = send(BOB, ALICE)
+    run(window())
+    second, third = send(BOB, ALICE, 2)
+    run(recent_messages.append(third))
+    assert run(async_redis_client.llen(KEY)) == 2
+
+    # A lower id arriving after a higher one can't be pushed on top
+    run(recent_messages.append(second))
+    assert run(async_redis_client.exists(KEY)) == 0
+    read, hit = run(window())
+    assert not hit and sorted(read) == [first.id, second.id, third.id]
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from fastapi import HTTPException
+from database import AsyncSessionLocal, SessionLocal
+from models import ChatRoom, RoomMember, User
+from redis_client import async_redis_client
+from rooms import get_member_ids, members_key, user_rooms_key, version_key
+from routers.rooms import add_room_member, create_room, remove_room_member
+from schemas import RoomCreate, RoomMemberAdd
+
+pytestmark = pytest.mark.usefixtures("users")
+
+ALICE, BOB = 1, 2
+
+
+@pytest.fixture
+def room_id(run):
+    async def create():
+        async with AsyncSessionLocal() as db:
+            alice = await db.get(User, ALICE)
+            return (await create_room(RoomCreate(name="team", member_ids=[]), current_user=alice, db=db)).id
+
+    room_id = run(create())
+    yield room_id
+    with SessionLocal() as db:
+        db.query(RoomMember).delete()
+        db.query(ChatRoom).delete()
+        db.commit()
+    # SQLite hands the next room the same id
+    keys = [members_key(room_id), user_rooms_key(ALICE), user_rooms_key(BOB)]
+    run(async_redis_client.delete(*keys, *map(version_key, keys)))
+
+
+async def as_alice(endpoint, *args):
+    async with AsyncSessionLocal() as db:
+        return await endpoint(*args, current_user=await db.get(User, ALICE), db=db)
+
+
+def test_adding_a_member_another_request_just_added_succeeds(run, room_id):
+    async def cache_members():
+        async with AsyncSessionLocal() as db:
+            return await get_member_ids(db, room_id)
+
+    # The cached set still says bob is out when the other request's row lands
+    assert run(cache_members()) == {ALICE}
+    with SessionLocal() as db:
+        db.add(RoomMember(room_id=room_id, user_id=BOB))
+        db.commit()
+
+    room = run(as_alice(add_room_member, room_id, RoomMemberAdd(user_id=BOB)))
+    assert room.member_ids == [ALICE, BOB]
+    with SessionLocal() as db:
+        assert db.query(RoomMember).filter_by(room_id=room_id).count() == 2
+
+
+def test_removing_a_non_member_is_404(run, room_id):
+    with pytest.raises(HTTPException) as raised:
+        run(as_alice(remove_room_member, room_id, BOB))
+    assert raised.value.status_code == 404
+
+    run(as_alice(add_room_member, room_id, RoomMemberAdd(user_id=BOB)))
+    assert run(as_alice(remove_room_member, room_id, BOB)) == {"message": "Member removed"}
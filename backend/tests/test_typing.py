@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+
+import websocket_manager
+from config import settings
+from websocket_manager import Connection, ConnectionManager
+
+ALICE, BOB = 1, 2
+
+
+@pytest.fixture
+def delivered(monkeypatch):
+    """(recipient ids, is_typing) of every typing event sent to a partner"""
+    events = []
+
+    async def deliver(user_ids, message, replayable=False):
+        events.append((list(user_ids), message["is_typing"]))
+
+    monkeypatch.setattr(websocket_manager, "deliver_to_users", deliver)
+    return events
+
+
+@pytest.fixture
+def manager():
+    return ConnectionManager("worker-typing")
+
+
+@pytest.fixture
+def conn():
+    return Connection(None, ALICE, "alice", {"dropped": 0, "evicted": 0}, worker_id="worker-typing")
+
+
+def typing(run, manager, conn, *states):
+    async def send():
+        for is_typing in states:
+            await manager.update_typing(conn, BOB, is_typing)
+    run(send())
+
+
+def test_keystrokes_while_typing_are_coalesced(run, manager, conn, delivered):
+    typing(run, manager, conn, True, True, True, False)
+
+    assert delivered == [([BOB], True), ([BOB], False)]
+    assert manager.typing_stats["coalesced"] == 2
+    assert manager.typing_stats["forwarded"] == 2
+    assert conn.typing == {}
+
+
+def test_stop_without_start_is_not_forwarded(run, manager, conn, delivered):
+    typing(run, manager, conn, False)
+
+    assert delivered == []
+    assert manager.typing_stats["coalesced"] == 1
+
+
+def test_silence_sends_the_stop(run, manager, conn, delivered, monkeypatch):
+    monkeypatch.setattr(settings, "typing_timeout_seconds", 0.01)
+    typing(run, manager, conn, True)
+    run(asyncio.sleep(0.05))
+
+    assert delivered == [([BOB], True), ([BOB], False)]
+    assert manager.typing_stats["expired"] == 1
+    assert conn.typing == {}
+
+
+def test_starts_are_rate_limited_but_stops_never_are(run, manager, conn, delivered, monkeypatch):
+    monkeypatch.setattr(settings, "typing_burst", 2)
+    monkeypatch.setattr(settings, "typing_events_per_second", 0)
+    conn._typing_tokens = 2
+
+    typing(run, manager, conn, True, False, True, False, True, False)
+
+    assert delivered == [([BOB], True), ([BOB], False)] * 2
+    assert manager.typing_stats["rate_limited"] == 1
+    assert manager.typing_stats["coalesced"] == 1
@@ -0,0 +1,101 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+from database import AsyncSessionLocal, SessionLocal
+from models import Message, ReadWatermark
+from read_receipts import mark_conversation_read
+from redis_client import async_redis_client
+from unread_counters import unread_counters
+
+pytestmark = pytest.mark.usefixtures("users")
+
+ALICE, BOB = 1, 2
+
+
+@pytest.fixture(autouse=True)
+def clean(run):
+    with SessionLocal() as db:
+        db.query(Message).delete()
+        db.query(ReadWatermark).delete()
+        db.commit()
+    run(async_redis_client.delete(unread_counters.key(ALICE), unread_counters.generation_key(ALICE)))
+
+
+def send(count=1):
+    """Commit messages from bob to alice without touching the counters"""
+    with SessionLocal() as db:
+        messages = [Message(content="hi", sender_id=BOB, receiver_id=ALICE) for _ in range(count)]
+        db.add_all(messages)
+        db.commit()
+        return [message.id for message in messages]
+
+
+async def total():
+    async with AsyncSessionLocal() as db:
+        return await unread_counters.total(db, ALICE)
+
+
+def test_increment_after_a_rebuild_that_saw_the_message(run):
+    [message_id] = send()
+    # The rebuild runs between the commit and the sender's increment
+    assert run(total()) == 1
+    run(unread_counters.increment(ALICE, BOB, message_id))
+    assert run(total()) == 1
+
+
+def test_increment_between_snapshot_and_store(run, monkeypatch):
+    send()
+    snapshots = unread_counters._snapshots
+    late = []
+
+    async def snapshot_then_send(db, user_ids):
+        result = await snapshots(db, user_ids)
+        [message_id] = send()
+        await unread_counters.increment(ALICE, BOB, message_id)
+        late.append(message_id)
+        return result
+
+    monkeypatch.setattr(unread_counters, "_snapshots", snapshot_then_send)
+    assert run(total()) == 1
+    monkeypatch.undo()
+    # The stale snapshot was not stored, so this read counts both
+    assert late and run(total()) == 2
+    run(unread_counters.increment(ALICE, BOB, send()[0]))
+    assert run(total()) == 3
+
+
+def test_decrement_after_a_rebuild_that_saw_the_receipt(run, monkeypatch):
+    message_ids = send(3)
+    receipts = []
+
+    async def hold_decrement(*args):
+        receipts.append(args)
+
+    async def read_up_to(message_id):
+        async with AsyncSessionLocal() as db:
+            return await mark_conversation_read(db, ALICE, BOB, message_id)
+
+    monkeypatch.setattr(unread_counters, "decrement", hold_decrement)
+    assert run(read_up_to(message_ids[1]))["marked_read"] == 2
+    monkeypatch.undo()
+
+    # The rebuild runs between the receipt's commit and its decrement
+    assert run(total()) == 1
+    run(unread_counters.decrement(*receipts[0]))
+    assert run(total()) == 1
+
+    # A later receipt the rebuild never saw still counts down
+    assert run(read_up_to(message_ids[2]))["marked_read"] == 1
+    assert run(total()) == 0
+
+
+def test_conversation_counts_skip_the_marks(run):
+    send(2)
+    run(total())
+
+    async def by_conversation():
+        async with AsyncSessionLocal() as db:
+            return await unread_counters.by_conversation(db, ALICE)
+
+    assert run(by_conversation()) == {BOB: 2}
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import codec
+import messaging
+from database import SessionLocal
+from main import receive_chat_message
+from models import Message, User
+
+pytestmark = pytest.mark.usefixtures("users")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.replies = []
+
+    def enqueue(self, payload, event_type):
+        self.replies.append(codec.loads(payload))
+
+
+@pytest.fixture
+def send(run):
+    return lambda client_id, content: run(_send(client_id, content))
+
+
+async def _send(client_id, content):
+    """Run one WebSocket "message" frame from alice to bob; returns the reply"""
+    connection = FakeConnection()
+    alice = User(id=1, username="alice")
+    frame = {"type": "message", "content": content, "receiver_id": 2, "client_id": client_id}
+    await receive_chat_message(connection, alice, frame)
+    [reply] = connection.replies
+    return reply
+
+
+def stored(content):
+    with SessionLocal() as db:
+        return db.query(Message).filter(Message.content == content).count()
+
+
+def test_resend_is_acked_as_duplicate(send):
+    first = send("resend", "resend")
+    again = send("resend", "resend")
+    assert first["type"] == "ack" and not first["duplicate"]
+    assert again["type"] == "ack" and again["duplicate"] and again["id"] == first["id"]
+    assert stored("resend") == 1
+
+
+def test_failure_after_commit_keeps_the_claim(monkeypatch, send):
+    async def broken_delivery(*args, **kwargs):
+        raise ConnectionError("redis went away")
+
+    monkeypatch.setattr(messaging, "deliver_to_users", broken_delivery)
+    failed = send("after-commit", "after commit")
+    monkeypatch.undo()
+    retried = send("after-commit", "after commit")
+
+    assert failed["type"] == "error"
+    assert retried["type"] == "ack" and retried["duplicate"]
+    assert stored("after commit") == 1
+
+
+def test_failure_before_commit_releases_the_claim(monkeypatch, send):
+    async def broken_record(*args, **kwargs):
+        raise ConnectionError("database went away")
+
+    monkeypatch.setattr(messaging, "record_messages", broken_record)
+    failed = send("before-commit", "before commit")
+    monkeypatch.undo()
+    retried = send("before-commit", "before commit")
+
+    assert failed["type"] == "error"
+    assert retried["type"] == "ack" and not retried["duplicate"]
+    assert stored("before commit") == 1
@@ -0,0 +1,224 @@
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+from sqlalchemy import select, func, literal, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from message_writer import message_writer
+from models import Message, ReadWatermark
+from redis_client import async_redis_client
+
+# unread:{user_id} is a hash of partner_id -> unread count plus a "total"
+# field. A missing key means "unknown" and is rebuilt from the database on
+# first read; counters are only adjusted while the key exists.
+#
+# A rebuild races with sends and read receipts in two ways, and each has
+# its own fence:
+#
+# - An adjustment lands between the rebuild's SELECT and its store. Every
+#   adjustment bumps unread_gen:{user_id}, even when the hash is missing,
+#   and a rebuild only stores its snapshot if the generation is unchanged.
+# - A message or receipt commits before the SELECT but adjusts after the
+#   store, so the snapshot already counts it. The hash records what the
+#   snapshot covered: "covered", the newest message id it saw, and
+#   "read:{partner_id}", each read watermark it saw. An increment for a
+#   message at or below "covered", or a decrement for a receipt at or below
+#   its watermark, is skipped.
+#
+# The snapshot is a single statement, so the counts and marks agree. Two
+# cases it can't see are left to reconcile_unread.py: a row that commits
+# after a higher id (ids are handed out before commit), and rows another
+# worker still has buffered by write-behind.
+
+# KEYS[1] = hash, KEYS[2] = generation
+# ARGV[1] = partner, ARGV[2] = amount, ARGV[3] = generation TTL,
+# ARGV[4] = mark field, ARGV[5] = message id the adjustment is for
+ADJUST_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local mark = redis.call('HGET', KEYS[1], ARGV[4])
+if mark and tonumber(mark) >= tonumber(ARGV[5]) then
+    return 0
+end
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+local total = redis.call('HINCRBY', KEYS[1], 'total', ARGV[2])
+if count <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+if total < 0 then
+    redis.call('HSET', KEYS[1], 'total', 0)
+end
+return 1
+"""
+
+# ARGV[1] = generation read before counting, ARGV[2] = '1' to only fill a
+# missing hash, ARGV[3..] = field/value pairs
+STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '1' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+return 1
+"""
+
+TOTAL_FIELD = "total"
+COVERED_FIELD = "covered"
+
+# Only needs to outlive a rebuild's SELECT
+GENERATION_TTL_SECONDS = 86400
+
+RECONCILE_BATCH_SIZE = 500
+
+
+def read_mark_field(partner_id: int) -> str:
+    return f"read:{partner_id}"
+
+
+def snapshot_query(user_ids: Iterable[int]):
+    """(kind, user_id, partner_id, value) rows for a rebuild, in one statement.
+
+    kind is "unread" (value = unread count from partner_id), "read" (value =
+    the pair's read watermark) or "covered" (value = newest message id the
+    user received).
+    """
+    user_ids = list(user_ids)
+    return union_all(
+        select(literal("unread"), Message.receiver_id, Message.sender_id, func.count())
+        .where(Message.receiver_id.in_(user_ids), ~Message.is_read)
+        .group_by(Message.receiver_id, Message.sender_id),
+        select(
+            literal("read"), ReadWatermark.user_id, ReadWatermark.partner_id,
+            ReadWatermark.last_read_message_id,
+        ).where(ReadWatermark.user_id.in_(user_ids)),
+        select(literal("covered"), Message.receiver_id, literal(0), func.max(Message.id))
+        .where(Message.receiver_id.in_(user_ids))
+        .group_by(Message.receiver_id),
+    )
+
+
+class Snapshot:
+    """One user's counts and the marks of what they already include"""
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.read_marks: Dict[int, int] = {}
+        self.covered = 0
+
+    def fields(self) -> list:
+        fields = [TOTAL_FIELD, sum(self.counts.values()), COVERED_FIELD, self.covered]
+        for partner_id, count in self.counts.items():
+            fields += [partner_id, count]
+        for partner_id, message_id in self.read_marks.items():
+            fields += [read_mark_field(partner_id), message_id]
+        return fields
+
+
+class UnreadCounters:
+    """Per-user and per-conversation unread counts kept in Redis hashes"""
+
+    def __init__(self):
+        self.redis = async_redis_client
+        self._adjust = self.redis.register_script(ADJUST_SCRIPT)
+        self._store_counts = self.redis.register_script(STORE_SCRIPT)
+
+    def key(self, user_id: int) -> str:
+        return f"unread:{user_id}"
+
+    def generation_key(self, user_id: int) -> str:
+        return f"unread_gen:{user_id}"
+
+    async def increment(self, receiver_id: int, sender_id: int, message_id: int):
+        """Count a new message from sender_id to receiver_id"""
+        await self._adjust(
+            keys=[self.key(receiver_id), self.generation_key(receiver_id)],
+            args=[sender_id, 1, GENERATION_TTL_SECONDS, COVERED_FIELD, message_id],
+        )
+
+    async def decrement(self, reader_id: int, partner_id: int, amount: int, up_to_id: int):
+        """Uncount messages reader_id just read from partner_id, up to up_to_id"""
+        if amount:
+            await self._adjust(
+                keys=[self.key(reader_id), self.generation_key(reader_id)],
+                args=[partner_id, -amount, GENERATION_TTL_SECONDS, read_mark_field(partner_id), up_to_id],
+            )
+
+    async def total(self, db: AsyncSession, user_id: int) -> int:
+        """Total unread messages for a user, O(1) once the hash exists"""
+        total = await self.redis.hget(self.key(user_id), TOTAL_FIELD)
+        if total is None:
+            return sum((await self.rebuild(db, user_id)).values())
+        return max(int(total), 0)
+
+    async def by_conversation(self, db: AsyncSession, user_id: int) -> Dict[int, int]:
+        """Unread counts keyed by conversation partner"""
+        counts = await self.redis.hgetall(self.key(user_id))
+        if not counts:
+            return await self.rebuild(db, user_id)
+        return {
+            int(partner_id): int(count)
+            for partner_id, count in counts.items()
+            if partner_id.isdigit() and int(count) > 0
+        }
+
+    async def rebuild(self, db: AsyncSession, user_id: int) -> Dict[int, int]:
+        """Recompute one user's counters from the database"""
+        generation = await self.redis.get(self.generation_key(user_id))
+        snapshot = (await self._snapshots(db, [user_id]))[user_id]
+        # Skipped if the hash was filled or adjusted meanwhile; the next read retries
+        await self._store(user_id, snapshot, generation, only_if_missing=True)
+        return snapshot.counts
+
+    async def reconcile(self, db: AsyncSession) -> int:
+        """Rebuild every user's counters from the database; returns users stored.
+
+        Users whose counters change while their batch is being counted are
+        left as they are and picked up by the next run.
+        """
+        result = await db.execute(select(Message.receiver_id).where(~Message.is_read).distinct())
+        user_ids = set(result.scalars().all())
+        # Users with cached counters but nothing unread any more
+        async for key in self.redis.scan_iter(match="unread:*", count=1000):
+            user_ids.add(int(key.split(":", 1)[1]))
+
+        stored = 0
+        user_ids = sorted(user_ids)
+        for start in range(0, len(user_ids), RECONCILE_BATCH_SIZE):
+            batch = user_ids[start:start + RECONCILE_BATCH_SIZE]
+            generations = await self.redis.mget([self.generation_key(user_id) for user_id in batch])
+            snapshots = await self._snapshots(db, batch)
+            for user_id, generation in zip(batch, generations):
+                stored += await self._store(user_id, snapshots[user_id], generation)
+        return stored
+
+    async def _snapshots(self, db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, Snapshot]:
+        # Rows still buffered by write-behind would be missing from the counts
+        if message_writer.enabled:
+            await message_writer.flush()
+        snapshots: Dict[int, Snapshot] = defaultdict(Snapshot)
+        for kind, user_id, partner_id, value in await db.execute(snapshot_query(user_ids)):
+            snapshot = snapshots[user_id]
+            if kind == "unread":
+                snapshot.counts[partner_id] = value
+            elif kind == "read":
+                snapshot.read_marks[partner_id] = value
+            else:
+                snapshot.covered = value or 0
+        return snapshots
+
+    async def _store(
+        self, user_id: int, snapshot: Snapshot, generation: Optional[str],
+        only_if_missing: bool = False,
+    ) -> bool:
+        """Replace a user's counters unless they were adjusted since generation was read"""
+        return bool(await self._store_counts(
+            keys=[self.key(user_id), self.generation_key(user_id)],
+            args=[generation or "0", "1" if only_if_missing else "0", *snapshot.fields()],
+        ))
+
+
+unread_counters = UnreadCounters()
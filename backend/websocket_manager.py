@@ -1,104 +1,438 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List, Set
-import json
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
 import asyncio
+import time
+import codec
+from cache import get_user_profiles, get_contact_ids
+from cluster import WORKER_ID, new_connection_id, unpack_delivery
+from delivery import deliver_to_users
+from event_streams import events_since
+from config import settings
+from presence import presence
+from rooms import get_room_ids, room_channel, control_channel
 from redis_client import redis_manager
-from models import User, Message
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from redis_subscriber import RedisSubscriber, subscriber
+from database import AsyncSessionLocal
+from schemas import TypingIndicator
+
+
+# Low-value events that may be discarded when a client can't keep up
+DROPPABLE_EVENTS = {
+    event_type.strip() for event_type in settings.ws_droppable_events.split(",") if event_type.strip()
+}
+
+
+class Connection:
+    """A single client socket with a bounded outbound queue drained by its writer task"""
+    def __init__(
+        self, websocket: WebSocket, user_id: int, username: str, stats: Dict[str, int],
+        binary: bool = False, worker_id: str = WORKER_ID,
+    ):
+        self.id = new_connection_id(worker_id)
+        self.websocket = websocket
+        # Negotiated the MessagePack subprotocol: frames go out as bytes
+        self.binary = binary
+        self.user_id = user_id
+        self.username = username
+        # Outbound (payload, event type) frames waiting for the writer task
+        self.outbound: Deque[Tuple[str, Optional[str]]] = deque()
+        self.evicted = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._full_since: Optional[float] = None
+        self._stats = stats
+        # Partners this connection is shown typing to, with their auto-stop timers
+        self.typing: Dict[int, asyncio.TimerHandle] = {}
+        self._typing_tokens = float(settings.typing_burst)
+        self._typing_refilled = time.monotonic()
+    
+    def take_typing_token(self) -> bool:
+        """Token bucket capping the typing events this connection may emit"""
+        now = time.monotonic()
+        self._typing_tokens = min(
+            settings.typing_burst,
+            self._typing_tokens + (now - self._typing_refilled) * settings.typing_events_per_second,
+        )
+        self._typing_refilled = now
+        if self._typing_tokens < 1:
+            return False
+        self._typing_tokens -= 1
+        return True
+    
+    def enqueue(self, payload: str, event_type: Optional[str]) -> bool:
+        """Queue a frame for the writer task; returns False if it was not queued"""
+        if self.evicted.is_set():
+            return False
+        
+        if len(self.outbound) >= settings.ws_outbound_queue_size:
+            now = time.monotonic()
+            if self._full_since is None:
+                self._full_since = now
+            if now - self._full_since > settings.ws_slow_consumer_seconds:
+                self.evict("queue full too long")
+                return False
+            
+            droppable = event_type in DROPPABLE_EVENTS
+            if droppable and settings.ws_drop_policy == "drop_newest":
+                self._count_drop(event_type)
+                return False
+            # Make room by discarding the oldest queued low-value frame
+            if not self._drop_oldest_droppable():
+                if droppable:
+                    self._count_drop(event_type)
+                else:
+                    # Never silently lose a message; the client resyncs on reconnect
+                    self.evict("queue full")
+                return False
+        
+        self.outbound.append((payload, event_type))
+        self._ready.set()
+        return True
+    
+    def queue_replay(self, events: List[Tuple[int, str]]):
+        """Queue missed events ahead of live frames that arrived while they were read"""
+        queued_ids = set()
+        for payload, _ in self.outbound:
+            # Live events delivered during the replay read may be in both
+            if '"event_id"' in payload:
+                queued_ids.add(codec.loads(payload).get("event_id"))
+        for event_id, payload in reversed(events):
+            if event_id not in queued_ids:
+                self.outbound.appendleft((payload, None))
+        self._ready.set()
+    
+    def _drop_oldest_droppable(self) -> bool:
+        for index, (_, event_type) in enumerate(self.outbound):
+            if event_type in DROPPABLE_EVENTS:
+                del self.outbound[index]
+                self._count_drop(event_type)
+                return True
+        return False
+    
+    def _count_drop(self, event_type: Optional[str]):
+        self._stats["dropped"] += 1
+        key = f"dropped_{event_type}"
+        self._stats[key] = self._stats.get(key, 0) + 1
+    
+    def evict(self, reason: str):
+        """Mark a slow consumer for disconnection"""
+        if not self.evicted.is_set():
+            print(f"Evicting connection {self.id} of user {self.user_id}: {reason}")
+            self._stats["evicted"] += 1
+            self.outbound.clear()
+            self.evicted.set()
+    
+    async def run_writer(self):
+        """Send queued frames in order; blocks only this connection on a slow socket"""
+        while True:
+            while not self.outbound:
+                self._ready.clear()
+                await self._ready.wait()
+            payload, _ = self.outbound.popleft()
+            if len(self.outbound) < settings.ws_outbound_queue_size:
+                self._full_since = None
+            if self.binary:
+                await self.websocket.send_bytes(codec.json_to_msgpack(payload))
+            else:
+                await self.websocket.send_text(payload)
+    
+    async def receive(self) -> dict:
+        """Read and decode the next client frame"""
+        if self.binary:
+            return codec.unpack_msgpack(await self.websocket.receive_bytes())
+        return codec.loads(await self.websocket.receive_text())
 
 
 class ConnectionManager:
-    def __init__(self):
-        # Store active connections by user_id
-        self.active_connections: Dict[int, WebSocket] = {}
-        # Store user info for each connection
-        self.user_info: Dict[int, dict] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: int, username: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        self.user_info[user_id] = {"username": username, "user_id": user_id}
+    def __init__(self, worker_id: str = WORKER_ID, redis_subscriber: Optional[RedisSubscriber] = None):
+        # Which worker's channels this manager serves, and the PubSub
+        # connection it listens on; the process-wide ones unless overridden
+        self.worker_id = worker_id
+        self.subscriber = redis_subscriber or subscriber
+        # Store active connections by user_id, then connection id; a user
+        # may have several tabs or devices open at once
+        self.active_connections: Dict[int, Dict[str, Connection]] = {}
+        self.outbound_stats: Dict[str, int] = {"dropped": 0, "evicted": 0}
+        self.typing_stats: Dict[str, int] = {"forwarded": 0, "coalesced": 0, "rate_limited": 0, "expired": 0}
+        self.replay_stats: Dict[str, int] = {"replays": 0, "replayed_events": 0, "resyncs": 0}
+        # Group rooms with members connected to this worker, both ways round
+        self.local_rooms: Dict[int, Set[int]] = {}
+        self.local_user_rooms: Dict[int, Set[int]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+    
+    async def start(self):
+        """Listen for deliveries to this worker and start presence heartbeats"""
+        await self.subscriber.subscribe(redis_manager.get_worker_channel(self.worker_id), self._on_delivery)
+        await self.subscriber.subscribe(control_channel(self.worker_id), self._on_room_membership)
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+    
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+    
+    async def connect(
+        self, websocket: WebSocket, user_id: int, username: str, last_event_id: Optional[int] = None
+    ) -> Connection:
+        # Binary frames only for clients that ask for them, and only if msgpack is installed
+        binary = (
+            codec.MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+            and codec.msgpack_available()
+        )
+        await websocket.accept(subprotocol=codec.MSGPACK_SUBPROTOCOL if binary else None)
+        connection = Connection(
+            websocket, user_id, username, self.outbound_stats, binary, self.worker_id
+        )
+        user_connections = self.active_connections.setdefault(user_id, {})
+        user_connections[connection.id] = connection
         
-        # Add user to online users in Redis
-        redis_manager.add_online_user(user_id)
+        try:
+            # Route the user's group rooms to this worker
+            if len(user_connections) == 1:
+                async with AsyncSessionLocal() as db:
+                    room_ids = await get_room_ids(db, user_id)
+                for room_id in room_ids:
+                    await self._add_room_member(room_id, user_id)
+            
+            # Only the user's first connection anywhere makes them come online
+            came_online = await presence.connect(user_id, connection.id)
+            # Replay only once registered, so later events are delivered live
+            if last_event_id is not None:
+                await self.replay(connection, last_event_id)
+            if came_online:
+                await self.broadcast_user_status(user_id, username, True)
+        except BaseException:
+            # The caller never gets the connection to disconnect it, and the
+            # heartbeat would keep a registered one online indefinitely
+            try:
+                await self.disconnect(connection)
+            except Exception as e:
+                print(f"Error unregistering connection {connection.id}: {e}")
+            raise
+        return connection
+    
+    async def replay(self, connection: Connection, last_event_id: int):
+        """Send a reconnecting client the events it missed, or ask it to resync"""
+        # Leave the outbound queue room for live frames
+        events = await events_since(
+            connection.user_id, last_event_id, settings.ws_outbound_queue_size // 2
+        )
+        if events is None:
+            self.replay_stats["resyncs"] += 1
+            connection.enqueue(codec.dumps({"type": "resync"}), "resync")
+            return
+        self.replay_stats["replays"] += 1
+        self.replay_stats["replayed_events"] += len(events)
+        connection.queue_replay(events)
+    
+    async def disconnect(self, connection: Connection):
+        user_connections = self.active_connections.get(connection.user_id, {})
+        if user_connections.pop(connection.id, None) is None:
+            return
+        # Don't leave partners looking at a typing indicator for a closed tab
+        for partner_id in list(connection.typing):
+            await self.update_typing(connection, partner_id, False)
+        if not user_connections:
+            del self.active_connections[connection.user_id]
+            for room_id in list(self.local_user_rooms.get(connection.user_id, ())):
+                await self._remove_room_member(room_id, connection.user_id)
         
-        # Notify other users that this user is online
-        await self.broadcast_user_status(user_id, username, True)
-    
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            if user_id in self.user_info:
-                username = self.user_info[user_id]["username"]
-                del self.user_info[user_id]
-                
-                # Remove user from online users in Redis
-                redis_manager.remove_online_user(user_id)
-                
-                # Notify other users that this user is offline
-                asyncio.create_task(self.broadcast_user_status(user_id, username, False))
+        # Another tab or device may still hold the user online
+        if await presence.disconnect(connection.user_id, connection.id):
+            await self.broadcast_user_status(connection.user_id, connection.username, False)
+    
+    def stats(self) -> dict:
+        """Connection counts and outbound queue metrics"""
+        depths = [
+            len(connection.outbound)
+            for user_connections in self.active_connections.values()
+            for connection in user_connections.values()
+        ]
+        return {
+            "active_connections": len(depths),
+            "connected_users": len(self.active_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "local_rooms": len(self.local_rooms),
+            **self.outbound_stats,
+            "typing": self.typing_stats,
+            "replay": self.replay_stats,
+        }
+    
+    async def _heartbeat(self):
+        interval = max(settings.presence_ttl_seconds / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await presence.heartbeat(
+                    (connection.user_id, connection.id)
+                    for user_connections in self.active_connections.values()
+                    for connection in user_connections.values()
+                )
+                # Users whose heartbeats lapsed (e.g. their worker crashed)
+                for user_id in await presence.sweep():
+                    await self.broadcast_user_status(user_id, None, False)
+            except Exception as e:
+                print(f"Presence heartbeat error: {e}")
+    
+    def _on_delivery(self, data: str):
+        """Hand a payload published to this worker to its recipients' sockets"""
+        user_ids, payload, event_type = unpack_delivery(data)
+        if event_type is None:
+            event_type = codec.loads(payload).get("type")
+        for user_id in user_ids:
+            self.dispatch(user_id, payload, event_type)
+    
+    async def _add_room_member(self, room_id: int, user_id: int):
+        members = self.local_rooms.setdefault(room_id, set())
+        is_first = not members
+        members.add(user_id)
+        self.local_user_rooms.setdefault(user_id, set()).add(room_id)
+        if is_first:
+            # Start receiving the room's messages on this worker
+            await self.subscriber.subscribe(
+                room_channel(room_id), lambda data: self._on_room_message(room_id, data)
+            )
+    
+    async def _remove_room_member(self, room_id: int, user_id: int):
+        user_rooms = self.local_user_rooms.get(user_id)
+        if user_rooms is not None:
+            user_rooms.discard(room_id)
+            if not user_rooms:
+                del self.local_user_rooms[user_id]
+        members = self.local_rooms.get(room_id)
+        if members is None:
+            return
+        members.discard(user_id)
+        if not members:
+            del self.local_rooms[room_id]
+            await self.subscriber.unsubscribe(room_channel(room_id))
+    
+    def _on_room_message(self, room_id: int, data: str):
+        """Fan a room message, published once cluster-wide, out to local members"""
+        members = self.local_rooms.get(room_id)
+        if not members:
+            return
+        _, payload, event_type = unpack_delivery(data)
+        for user_id in list(members):
+            self.dispatch(user_id, payload, event_type)
+    
+    def _on_room_membership(self, data: str):
+        """Start or stop routing a room to local users after a membership change"""
+        change = codec.loads(data)
+        user_ids = [user_id for user_id in change["user_ids"] if user_id in self.active_connections]
+        update = self._add_room_member if change["joined"] else self._remove_room_member
+        for user_id in user_ids:
+            self._spawn(update(change["room_id"], user_id))
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+    
+    def dispatch(self, user_id: int, data: str, event_type: Optional[str] = None):
+        """Queue a payload on every local connection of a user"""
+        user_connections = self.active_connections.get(user_id)
+        if not user_connections:
+            return
+        if event_type is None:
+            # Parsed once per payload, not once per connection
+            event_type = codec.loads(data).get("type")
+        for connection in list(user_connections.values()):
+            connection.enqueue(data, event_type)
     
     async def send_personal_message(self, message: str, user_id: int):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
-    
-    async def send_message_to_chat(self, message_data: dict, sender_id: int, receiver_id: int):
-        """Send message to both sender and receiver in a 1:1 chat"""
-        # Send to sender
-        if sender_id in self.active_connections:
-            await self.active_connections[sender_id].send_text(json.dumps(message_data))
-        
-        # Send to receiver
-        if receiver_id in self.active_connections:
-            await self.active_connections[receiver_id].send_text(json.dumps(message_data))
+        """Send to the user's connections on this worker only"""
+        self.dispatch(user_id, message)
     
-    async def broadcast_user_status(self, user_id: int, username: str, is_online: bool):
-        """Broadcast user online/offline status to all connected users"""
+    async def broadcast_user_status(self, user_id: int, username: Optional[str], is_online: bool):
+        """Send a user's online/offline status to their contacts and watchers"""
+        async with AsyncSessionLocal() as db:
+            if username is None:
+                profile = (await get_user_profiles(db, [user_id])).get(user_id)
+                username = profile["username"] if profile else None
+            audience = set(await get_contact_ids(db, user_id))
+        audience |= await presence.watchers(user_id)
+        audience.discard(user_id)
+        
         status_message = {
             "type": "user_status",
             "user_id": user_id,
             "username": username,
             "is_online": is_online
         }
+        # Serialized once and published in one pipeline; each recipient's
+        # writer task sends it, so a slow socket only delays itself
+        await deliver_to_users(audience, status_message)
+    
+    async def update_typing(self, connection: Connection, partner_id: int, is_typing: bool):
+        """Forward only typing start/stop transitions to the partner.
         
-        for connection in self.active_connections.values():
-            try:
-                await connection.send_text(json.dumps(status_message))
-            except:
-                pass  # Connection might be closed
+        Clients send a typing frame per keystroke; repeats while already typing
+        just push back the auto-stop timer. Starts count against the
+        connection's rate limit, stops never do, so a partner can't be left
+        with a stuck indicator.
+        """
+        timer = connection.typing.pop(partner_id, None)
+        if timer is not None:
+            timer.cancel()
+        
+        if is_typing:
+            if timer is None and not connection.take_typing_token():
+                self.typing_stats["rate_limited"] += 1
+                return
+            connection.typing[partner_id] = asyncio.get_running_loop().call_later(
+                settings.typing_timeout_seconds, self._expire_typing, connection, partner_id
+            )
+            if timer is not None:
+                self.typing_stats["coalesced"] += 1
+                return
+        elif timer is None:
+            # Not shown as typing, nothing to stop
+            self.typing_stats["coalesced"] += 1
+            return
+        
+        await self.send_typing_indicator(connection, partner_id, is_typing)
     
-    async def send_typing_indicator(self, typing_data: dict, sender_id: int, receiver_id: int):
-        """Send typing indicator to chat partner"""
-        if receiver_id in self.active_connections:
-            await self.active_connections[receiver_id].send_text(json.dumps(typing_data))
+    def _expire_typing(self, connection: Connection, partner_id: int):
+        if connection.typing.pop(partner_id, None) is None:
+            return
+        self.typing_stats["expired"] += 1
+        self._spawn(self.send_typing_indicator(connection, partner_id, False))
+    
+    async def send_typing_indicator(self, connection: Connection, partner_id: int, is_typing: bool):
+        """Send a typing transition to the partner on whichever worker holds them"""
+        self.typing_stats["forwarded"] += 1
+        typing_event = TypingIndicator(
+            user_id=connection.user_id,
+            username=connection.username,
+            is_typing=is_typing,
+            chat_partner_id=partner_id,
+        ).model_dump()
+        await deliver_to_users([partner_id], {"type": "typing", **typing_event})
     
     async def broadcast_online_users(self, user_id: int):
         """Send list of online users to a specific user"""
-        online_users = redis_manager.get_online_users()
-        online_user_list = []
+        online_users = await presence.online_user_ids()
+        online_users.discard(user_id)  # Don't include self
         
         # Get user details for online users
-        db = SessionLocal()
-        try:
-            for online_user_id in online_users:
-                if int(online_user_id) != user_id:  # Don't include self
-                    user = db.query(User).filter(User.id == int(online_user_id)).first()
-                    if user:
-                        online_user_list.append({
-                            "id": user.id,
-                            "username": user.username,
-                            "is_online": True
-                        })
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            profiles = await get_user_profiles(db, online_users)
+        online_user_list = [
+            {"id": profile["id"], "username": profile["username"], "is_online": True}
+            for profile in profiles.values()
+        ]
         
         message = {
             "type": "online_users",
             "users": online_user_list
         }
         
-        await self.send_personal_message(json.dumps(message), user_id)
+        await self.send_personal_message(codec.dumps(message), user_id)
 
 
 manager = ConnectionManager()
@@ -2,6 +2,7 @@
 
 import React, { useState, useRef, useEffect } from 'react';
 import { Send } from 'lucide-react';
+import { toast } from 'react-hot-toast';
 import { useChat } from '@/contexts/ChatContext';
 
 interface MessageInputProps {
@@ -32,7 +33,9 @@ export const MessageInput: React.FC<MessageInputProps> = ({
         setIsTyping(false);
       }
     } catch (error) {
+      // The text stays in the input so the user can try again
       console.error('Error sending message:', error);
+      toast.error(error instanceof Error ? error.message : 'Failed to send message');
     }
   };
 
@@ -1,11 +1,14 @@
 'use client';
 
-import React, { createContext, useContext, useState, useEffect, ReactNode } from 'react';
+import React, { createContext, useContext, useState, useEffect, useRef, ReactNode } from 'react';
 import { Message, OnlineUser, User, ChatContextType, WebSocketMessage } from '@/types';
 import { messagesAPI, usersAPI } from '@/lib/api';
-import { wsManager } from '@/lib/websocket';
+import { wsManager, SocketUnavailableError } from '@/lib/websocket';
 import { useAuth } from './AuthContext';
 
+// How often the presence watch list and online users are refreshed
+const PRESENCE_REFRESH_MS = 60000;
+
 const ChatContext = createContext<ChatContextType | undefined>(undefined);
 
 export const useChat = () => {
@@ -26,6 +29,12 @@ export const ChatProvider: React.FC<ChatProviderProps> = ({ children }) => {
   const [onlineUsers, setOnlineUsers] = useState<OnlineUser[]>([]);
   const [currentChatUser, setCurrentChatUser] = useState<OnlineUser | null>(null);
   const [typingUsers, setTypingUsers] = useState<Set<number>>(new Set());
+  // Read by socket handlers, which are registered once per login
+  const currentChatUserRef = useRef<OnlineUser | null>(null);
+
+  useEffect(() => {
+    currentChatUserRef.current = currentChatUser;
+  }, [currentChatUser]);
 
   useEffect(() => {
     if (!user) return;
@@ -37,7 +46,8 @@ export const ChatProvider: React.FC<ChatProviderProps> = ({ children }) => {
     const handleMessage = (data: WebSocketMessage) => {
       if (data.type === 'message') {
         const message = data as unknown as Message;
-        setMessages(prev => [message, ...prev]);
+        // The sender also receives its own messages on other open sessions
+        setMessages(prev => prev.some(m => m.id === message.id) ? prev : [message, ...prev]);
       }
     };
 
@@ -60,6 +70,8 @@ export const ChatProvider: React.FC<ChatProviderProps> = ({ children }) => {
     const handleOnlineUsers = (data: WebSocketMessage) => {
       if (data.type === 'online_users') {
         setOnlineUsers(data.users as OnlineUser[]);
+        // Sent on every (re)connect, so the watch list is renewed each time
+        watchDirectory();
       }
     };
 
@@ -77,19 +89,67 @@ export const ChatProvider: React.FC<ChatProviderProps> = ({ children }) => {
       }
     };
 
+    const handleReadReceipt = (data: WebSocketMessage) => {
+      if (data.type === 'read_receipt') {
+        // One receipt covers every message up to up_to_id in the conversation
+        setMessages(prev => prev.map(m =>
+          m.sender_id === data.partner_id &&
+          m.receiver_id === data.reader_id &&
+          m.id <= (data.up_to_id as number) &&
+          !m.is_read
+            ? { ...m, is_read: true }
+            : m
+        ));
+      }
+    };
+
+    const handleResync = (data: WebSocketMessage) => {
+      if (data.type === 'resync') {
+        // Too much was missed to replay; reload from the REST endpoints
+        loadOnlineUsers();
+        if (currentChatUserRef.current) {
+          loadConversation(currentChatUserRef.current.id);
+        }
+      }
+    };
+
     wsManager.onMessage('message', handleMessage);
     wsManager.onMessage('user_status', handleUserStatus);
     wsManager.onMessage('online_users', handleOnlineUsers);
     wsManager.onMessage('typing', handleTyping);
+    wsManager.onMessage('read_receipt', handleReadReceipt);
+    wsManager.onMessage('resync', handleResync);
+
+    // Users who registered since the last refresh are only found by fetching
+    // the directory again; the online list also catches anyone past the
+    // server's watch cap
+    const presenceRefresh = setInterval(() => {
+      watchDirectory();
+      loadOnlineUsers();
+    }, PRESENCE_REFRESH_MS);
 
     return () => {
+      clearInterval(presenceRefresh);
       wsManager.removeMessageHandler('message', handleMessage);
       wsManager.removeMessageHandler('user_status', handleUserStatus);
       wsManager.removeMessageHandler('online_users', handleOnlineUsers);
       wsManager.removeMessageHandler('typing', handleTyping);
+      wsManager.removeMessageHandler('read_receipt', handleReadReceipt);
+      wsManager.removeMessageHandler('resync', handleResync);
     };
   }, [user]);
 
+  // Presence updates only reach contacts and explicit watchers, so watch the
+  // whole user directory, not just whoever was online at connect time
+  const watchDirectory = async () => {
+    try {
+      const users = await usersAPI.getAllUsers();
+      wsManager.subscribePresence(users.map(u => u.id));
+    } catch (error) {
+      console.error('Error loading users:', error);
+    }
+  };
+
   const loadOnlineUsers = async () => {
     try {
       const users = await usersAPI.getOnlineUsers();
@@ -100,9 +160,22 @@ export const ChatProvider: React.FC<ChatProviderProps> = ({ children }) => {
   };
 
   const sendMessage = async (content: string, receiverId: number) => {
+    try {
+      // Over the socket the message shows up via its 'message' event; wait
+      // for the ack so failures reach the caller
+      await wsManager.sendChatMessage(content, receiverId, crypto.randomUUID());
+      return;
+    } catch (error) {
+      // Once handed to the socket it may have been stored, so only a send
+      // that never left falls back to REST, which can't dedupe it
+      if (!(error instanceof SocketUnavailableError)) {
+        console.error('Error sending message:', error);
+        throw error;
+      }
+    }
     try {
       const message = await messagesAPI.sendMessage(content, receiverId);
-      setMessages(prev => [message, ...prev]);
+      setMessages(prev => prev.some(m => m.id === message.id) ? prev : [message, ...prev]);
     } catch (error) {
       console.error('Error sending message:', error);
       throw error;
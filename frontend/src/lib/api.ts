@@ -1,5 +1,5 @@
 import axios from 'axios';
-import { User, Message, MessageWithUsers, OnlineUser } from '@/types';
+import { User, Message, MessageWithUsers, OnlineUser, ConversationPage, Room, RoomDetail, RoomMessage, RoomMessagePage } from '@/types';
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
 
@@ -80,6 +80,58 @@ export const messagesAPI = {
     const response = await api.get('/messages/unread-count');
     return response.data;
   },
+  
+  getUnreadCounts: async (): Promise<{ total: number; conversations: Record<number, number> }> => {
+    const response = await api.get('/messages/unread-counts');
+    return response.data;
+  },
+};
+
+export const conversationsAPI = {
+  getConversations: async (before?: string, limit = 20): Promise<ConversationPage> => {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (before) params.set('before', before);
+    const response = await api.get(`/conversations/?${params}`);
+    return response.data;
+  },
+};
+
+export const roomsAPI = {
+  createRoom: async (name: string, memberIds: number[] = []): Promise<RoomDetail> => {
+    const response = await api.post('/rooms/', { name, member_ids: memberIds });
+    return response.data;
+  },
+
+  getRooms: async (): Promise<Room[]> => {
+    const response = await api.get('/rooms/');
+    return response.data;
+  },
+
+  getRoom: async (roomId: number): Promise<RoomDetail> => {
+    const response = await api.get(`/rooms/${roomId}`);
+    return response.data;
+  },
+
+  addMember: async (roomId: number, userId: number): Promise<RoomDetail> => {
+    const response = await api.post(`/rooms/${roomId}/members`, { user_id: userId });
+    return response.data;
+  },
+
+  removeMember: async (roomId: number, userId: number): Promise<void> => {
+    await api.delete(`/rooms/${roomId}/members/${userId}`);
+  },
+
+  sendMessage: async (roomId: number, content: string): Promise<RoomMessage> => {
+    const response = await api.post(`/rooms/${roomId}/messages`, { content });
+    return response.data;
+  },
+
+  getMessages: async (roomId: number, before?: string, limit = 50): Promise<RoomMessagePage> => {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (before) params.set('before', before);
+    const response = await api.get(`/rooms/${roomId}/messages?${params}`);
+    return response.data;
+  },
 };
 
 export default api;
@@ -1,24 +1,76 @@
 import { WebSocketMessage, TypingIndicator } from '@/types';
 
+// Event ids come from one global counter, and events published by different
+// servers can arrive out of order, so the highest id seen may sit above one
+// still in flight. An id becomes the resume point only after it has been
+// held this long, by when anything published before it has arrived.
+const EVENT_REORDER_WINDOW_MS = 2000;
+// Ids remembered to drop events that come both live and in a replay
+const SEEN_EVENT_IDS_MAX = 1000;
+// A chat message not acked within this long is sent again with the same
+// client_id, which the server dedupes, up to MAX_SEND_ATTEMPTS times
+const ACK_TIMEOUT_MS = 5000;
+const MAX_SEND_ATTEMPTS = 3;
+
+interface PendingSend {
+  frame: string;
+  attempts: number;
+  timer: ReturnType<typeof setTimeout> | null;
+  resolve: (ack: WebSocketMessage) => void;
+  reject: (error: Error) => void;
+}
+
+// Thrown when a message could not be handed to the socket at all, so it
+// is safe to send it another way
+export class SocketUnavailableError extends Error {
+  constructor() {
+    super('WebSocket is not connected');
+    this.name = 'SocketUnavailableError';
+  }
+}
+
 class WebSocketManager {
   private ws: WebSocket | null = null;
   private reconnectAttempts = 0;
   private maxReconnectAttempts = 5;
   private reconnectDelay = 1000;
+  // Sent on reconnect so the server replays everything after it
+  private resumeEventId: number | null = null;
+  // Received event ids, oldest first, and those not yet old enough to resume from
+  private seenEventIds: Set<number> = new Set();
+  private unsettledEvents: { id: number; receivedAt: number }[] = [];
   private messageHandlers: Map<string, ((data: WebSocketMessage) => void)[]> = new Map();
+  // Chat messages sent but not yet acked, by client_id
+  private pendingSends: Map<string, PendingSend> = new Map();
 
   connect(token: string) {
     const wsUrl = process.env.NEXT_PUBLIC_WS_URL || 'ws://localhost:8000';
-    this.ws = new WebSocket(`${wsUrl}/ws/${token}`);
+    const resume = this.resumeEventId !== null ? `?last_event_id=${this.resumeEventId}` : '';
+    // Events were received but none is safe to resume from: reload instead
+    const needsResync = this.resumeEventId === null && this.seenEventIds.size > 0;
+    this.ws = new WebSocket(`${wsUrl}/ws/${token}${resume}`);
 
     this.ws.onopen = () => {
       console.log('WebSocket connected');
       this.reconnectAttempts = 0;
+      if (needsResync) {
+        this.handleMessage({ type: 'resync' });
+      }
+      // Sends that went unacked on the previous socket, with their client_ids
+      this.pendingSends.forEach((_, clientId) => this.transmit(clientId));
     };
 
     this.ws.onmessage = (event) => {
       try {
         const message: WebSocketMessage = JSON.parse(event.data);
+        if (typeof message.event_id === 'number') {
+          // A replay can overlap with events already received live
+          if (this.seenEventIds.has(message.event_id)) return;
+          this.recordEvent(message.event_id);
+        }
+        if ((message.type === 'ack' || message.type === 'error') && typeof message.client_id === 'string') {
+          this.settleSend(message.client_id, message);
+        }
         this.handleMessage(message);
       } catch (error) {
         console.error('Error parsing WebSocket message:', error);
@@ -27,6 +79,10 @@ class WebSocketManager {
 
     this.ws.onclose = () => {
       console.log('WebSocket disconnected');
+      // Events received just before the close may have had lower ids still
+      // in flight on this socket; the replay resends them
+      this.settleEvents(Date.now());
+      this.unsettledEvents = [];
       this.attemptReconnect(token);
     };
 
@@ -35,6 +91,30 @@ class WebSocketManager {
     };
   }
 
+  private recordEvent(eventId: number) {
+    const now = Date.now();
+    this.seenEventIds.add(eventId);
+    if (this.seenEventIds.size > SEEN_EVENT_IDS_MAX) {
+      // Sets iterate in insertion order, so this is the oldest
+      this.seenEventIds.delete(this.seenEventIds.values().next().value as number);
+    }
+    this.unsettledEvents.push({ id: eventId, receivedAt: now });
+    this.settleEvents(now);
+  }
+
+  // Move the resume point past events held for the whole reorder window
+  private settleEvents(now: number) {
+    while (
+      this.unsettledEvents.length > 0 &&
+      now - this.unsettledEvents[0].receivedAt >= EVENT_REORDER_WINDOW_MS
+    ) {
+      const { id } = this.unsettledEvents.shift()!;
+      if (this.resumeEventId === null || id > this.resumeEventId) {
+        this.resumeEventId = id;
+      }
+    }
+  }
+
   private attemptReconnect(token: string) {
     if (this.reconnectAttempts < this.maxReconnectAttempts) {
       this.reconnectAttempts++;
@@ -43,9 +123,47 @@ class WebSocketManager {
       setTimeout(() => {
         this.connect(token);
       }, this.reconnectDelay * this.reconnectAttempts);
+    } else {
+      this.failPendingSends(new Error('Connection lost before the message was confirmed'));
     }
   }
 
+  // Send a pending frame and wait for its ack; gives up after MAX_SEND_ATTEMPTS
+  private transmit(clientId: string) {
+    const pending = this.pendingSends.get(clientId);
+    if (!pending || !this.ws || this.ws.readyState !== WebSocket.OPEN) return;
+    if (pending.timer !== null) clearTimeout(pending.timer);
+    if (pending.attempts >= MAX_SEND_ATTEMPTS) {
+      this.pendingSends.delete(clientId);
+      pending.reject(new Error('Message was not confirmed by the server'));
+      return;
+    }
+    pending.attempts++;
+    this.ws.send(pending.frame);
+    // A socket that closes meanwhile resends on reconnect instead
+    pending.timer = setTimeout(() => this.transmit(clientId), ACK_TIMEOUT_MS);
+  }
+
+  private settleSend(clientId: string, reply: WebSocketMessage) {
+    const pending = this.pendingSends.get(clientId);
+    if (!pending) return;
+    if (pending.timer !== null) clearTimeout(pending.timer);
+    this.pendingSends.delete(clientId);
+    if (reply.type === 'ack') {
+      pending.resolve(reply);
+    } else {
+      pending.reject(new Error((reply.detail as string) || 'Message could not be sent'));
+    }
+  }
+
+  private failPendingSends(error: Error) {
+    this.pendingSends.forEach(pending => {
+      if (pending.timer !== null) clearTimeout(pending.timer);
+      pending.reject(error);
+    });
+    this.pendingSends.clear();
+  }
+
   private handleMessage(message: WebSocketMessage) {
     const handlers = this.messageHandlers.get(message.type) || [];
     handlers.forEach(handler => handler(message));
@@ -77,11 +195,45 @@ class WebSocketManager {
     }
   }
 
+  // Resolves with the server's ack. Rejects with SocketUnavailableError when
+  // the socket is down, so the caller can fall back to REST, or with the
+  // server's error once the message was handed over
+  sendChatMessage(content: string, receiverId: number, clientId: string): Promise<WebSocketMessage> {
+    if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+      return Promise.reject(new SocketUnavailableError());
+    }
+    return new Promise((resolve, reject) => {
+      this.pendingSends.set(clientId, {
+        frame: JSON.stringify({
+          type: 'message',
+          content,
+          receiver_id: receiverId,
+          client_id: clientId,
+        }),
+        attempts: 0,
+        timer: null,
+        resolve,
+        reject,
+      });
+      this.transmit(clientId);
+    });
+  }
+
+  subscribePresence(userIds: number[]) {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN && userIds.length > 0) {
+      this.ws.send(JSON.stringify({ type: 'presence_subscribe', user_ids: userIds }));
+    }
+  }
+
   disconnect() {
     if (this.ws) {
       this.ws.close();
       this.ws = null;
     }
+    this.failPendingSends(new Error('Disconnected before the message was confirmed'));
+    this.resumeEventId = null;
+    this.seenEventIds.clear();
+    this.unsettledEvents = [];
     this.messageHandlers.clear();
   }
 
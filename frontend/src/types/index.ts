@@ -22,6 +22,46 @@ export interface MessageWithUsers extends Message {
   receiver: User;
 }
 
+export interface ConversationSummary {
+  partner_id: number;
+  partner_username: string | null;
+  last_message_id: number;
+  last_sender_id: number;
+  last_message_preview: string;
+  last_message_at: string;
+  unread_count: number;
+}
+
+export interface ConversationPage {
+  conversations: ConversationSummary[];
+  next_cursor: string | null;
+}
+
+export interface Room {
+  id: number;
+  name: string;
+  is_group: boolean;
+  created_by: number | null;
+  created_at: string;
+}
+
+export interface RoomDetail extends Room {
+  member_ids: number[];
+}
+
+export interface RoomMessage {
+  id: number;
+  room_id: number;
+  sender_id: number;
+  content: string;
+  created_at: string;
+}
+
+export interface RoomMessagePage {
+  messages: RoomMessage[];
+  next_cursor: string | null;
+}
+
 export interface OnlineUser {
   id: number;
   username: string;
@@ -36,7 +76,9 @@ export interface TypingIndicator {
 }
 
 export interface WebSocketMessage {
-  type: 'message' | 'user_status' | 'online_users' | 'typing';
+  type: 'message' | 'user_status' | 'online_users' | 'typing' | 'read_receipt' | 'ack' | 'error' | 'resync';
+  // Present on events the server can replay after a reconnect
+  event_id?: number;
   [key: string]: unknown;
 }
 